@@ -8,16 +8,10 @@ to install the package from the source archive.
 from setuptools import find_packages
 from setuptools import setup
 import os
-import sys
 
 version = 1.0
 README = open(os.path.join(os.path.dirname(__file__), "README.rst")).read()
 
-extra_install_requires = []
-if sys.version_info < (2, 7):
-    extra_install_requires.append('ordereddict>=1.1')
-
-
 setup(
     name="yamltypes",
     version=version,
@@ -28,8 +22,9 @@ setup(
     install_requires=[
         'pyyaml',
         'dictns == 1.4',
-
-    ] + extra_install_requires,
+    ],
+    # module __getattr__ (PEP 562) and asyncio.run
+    python_requires=">=3.7",
     license="BSD",
     packages=find_packages(),
     options={
@@ -46,6 +41,8 @@ setup(
     classifiers=[
         """License :: OSI Approved :: BSD License""",
         """Programming Language :: Python""",
+        """Programming Language :: Python :: 3""",
+        """Programming Language :: Python :: 3 :: Only""",
         """Topic :: Software Development :: Libraries :: Python Modules""",
         """Intended Audience :: Developers""",
     ],
@@ -1 +1,10 @@
-from .yamlconfig import YamlConfig, OrderedYamlConfig
+# the submodules are imported on first use, so that importing the package
+# (e.g. for its command line tools) does not pay for PyYAML before it is needed
+__all__ = ["YamlConfig", "OrderedYamlConfig", "YamlSpec"]
+
+
+def __getattr__(name):
+    if name in __all__:
+        from . import yamlconfig
+        return getattr(yamlconfig, name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -0,0 +1,66 @@
+"""asyncio counterparts of YamlConfig and OrderedYamlConfig
+
+Loading a config reads, parses and validates several files, which would block the event loop.
+The whole build is run in an executor: the default executor of the loop, or the one given
+(e.g. a ProcessPoolExecutor for big configs, the builder and its result are picklable).
+
+Usage::
+
+    cfg = await AsyncYamlConfig("product.yaml", customizations=[...])
+    cfgs = await validateConfigs(fns, concurrency=8, executor=pool)
+"""
+from __future__ import absolute_import
+
+import asyncio
+import functools
+
+from .yamlconfig import OrderedYamlConfigBuilder
+from .yamlconfig import YamlConfigBuilder
+
+
+def _build(builderClass, fn, kw):
+    # module level function, so that it can be sent to a process pool
+    return builderClass(fn, **kw)._ns
+
+
+async def _runBuilder(builderClass, fn, executor, kw):
+    loop = asyncio.get_running_loop()
+    # if the awaiting task is cancelled, the job is cancelled too if it did not start yet
+    return await loop.run_in_executor(executor, functools.partial(_build, builderClass, fn, kw))
+
+
+async def AsyncYamlConfig(fn, executor=None, **kw):
+    """same as YamlConfig, without blocking the event loop"""
+    return await _runBuilder(YamlConfigBuilder, fn, executor, kw)
+
+
+async def AsyncOrderedYamlConfig(fn, executor=None, **kw):
+    """same as OrderedYamlConfig, without blocking the event loop"""
+    return await _runBuilder(OrderedYamlConfigBuilder, fn, executor, kw)
+
+
+async def validateConfigs(fns, concurrency=8, executor=None, ordered=False,
+                          return_exceptions=False, **kw):
+    """load and validate several files, with at most `concurrency` of them in flight
+
+    Returns the list of the configs, in the order of fns. If return_exceptions is False,
+    the first error is raised and the pending loads are cancelled, else the exceptions
+    are returned in place of the failing configs.
+    The remaining keyword arguments are given to each builder.
+    """
+    if concurrency < 1:
+        raise ValueError("concurrency must be at least 1, not %r" % (concurrency,))
+    builderClass = OrderedYamlConfigBuilder if ordered else YamlConfigBuilder
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def load(fn):
+        async with semaphore:
+            return await _runBuilder(builderClass, fn, executor, kw)
+
+    tasks = [asyncio.ensure_future(load(fn)) for fn in fns]
+    try:
+        return await asyncio.gather(*tasks, return_exceptions=return_exceptions)
+    finally:
+        # on error or cancellation, do not leave loads running behind us
+        for task in tasks:
+            task.cancel()
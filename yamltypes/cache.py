@@ -0,0 +1,176 @@
+"""caches shared by the long running users of yamltypes (the validation server,
+ConfigHandle, services building many configs)
+"""
+from __future__ import absolute_import
+
+import collections
+import copy
+import datetime
+import os
+import threading
+
+from .yamlconfig import YamlSpec
+
+
+def fileStamp(fn):
+    """what identifies a version of the file fn: None if it does not exist"""
+    try:
+        st = os.stat(fn)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+class _RecordingBuilder(object):
+
+    """records the files loaded by a builder: the data file, the customizations, and the
+    files of the spec when the builder compiles it"""
+
+    def __init__(self, *args, **kw):
+        self.loaded = []
+        super(_RecordingBuilder, self).__init__(*args, **kw)
+
+    def _yamlLoad(self, fn):
+        self.loaded.append(fn)
+        return super(_RecordingBuilder, self)._yamlLoad(fn)
+
+
+_recordingBuilders = {}
+
+
+def recordingBuilder(builderClass):
+    """return a subclass of builderClass, recording in self.loaded the files it loads"""
+    if builderClass not in _recordingBuilders:
+        _recordingBuilders[builderClass] = type("Recording" + builderClass.__name__,
+                                                (_RecordingBuilder, builderClass), {})
+    return _recordingBuilders[builderClass]
+
+
+class SpecCache(object):
+
+    """compiled specs, recompiled when one of their source files changes, or when one of
+    their missing type files is created"""
+
+    specClass = YamlSpec
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._specs = {}
+
+    def get(self, specfn, yamltypes_dirs, additionnal_types=None):
+        key = (os.path.abspath(specfn), tuple(yamltypes_dirs), additionnal_types)
+        with self._lock:
+            entry = self._specs.get(key)
+        if entry is not None:
+            spec, stamps = entry
+            if all(fileStamp(fn) == stamp for fn, stamp in stamps):
+                return spec
+        # compiled outside of the lock, two threads may compile the same spec,
+        # but they do not wait for each others specs
+        spec = self.specClass(specfn, yamltypes_dirs=yamltypes_dirs,
+                              additionnal_types=additionnal_types)
+        stamps = [(fn, fileStamp(fn)) for fn in spec.sources + spec.missing]
+        with self._lock:
+            self._specs[key] = (spec, stamps)
+        return spec
+
+
+# values which are not copied, the other ones than dicts and lists are deep copied
+_immutableTypes = (str, bytes, int, float, bool, type(None), datetime.date)
+# the most common ones, skipped early
+_scalarTypes = frozenset([str, int, float, bool, type(None)])
+
+
+def _copyValue(val):
+    if isinstance(val, _immutableTypes):
+        return val
+    if isinstance(val, (tuple, frozenset)) and all(isinstance(v, _immutableTypes) for v in val):
+        return val
+    # sets, python objects, etc.
+    return copy.deepcopy(val)
+
+
+def copyDocument(val):
+    """copy a parsed document: its dicts and lists, and its other mutable values"""
+    if not isinstance(val, (dict, list)):
+        return _copyValue(val)
+    # the empty copies of the containers are created, in order, before being filled,
+    # without recursion. Values appearing several times (yaml aliases) are copied once
+    ret = type(val)()
+    copies = {id(val): ret}
+    todo = [(val, ret)]
+    while todo:
+        v, new = todo.pop()
+        if isinstance(v, dict):
+            items = v.items()
+        else:
+            items = enumerate(v)
+            new.extend(v)
+        for k, i in items:
+            if type(i) not in _scalarTypes:
+                c = copies.get(id(i))
+                if c is None:
+                    if isinstance(i, (dict, list)):
+                        c = type(i)()
+                        todo.append((i, c))
+                    else:
+                        c = _copyValue(i)
+                    copies[id(i)] = c
+                i = c
+            new[k] = i
+    return ret
+
+
+class ParsedFileCache(object):
+
+    """parsed yaml files, parsed again when they change
+
+    Builders mutate what they load (customizations, defaults), so a copy of the
+    cached document is returned each time. The least recently used documents are
+    evicted once the total size of their files exceeds maxBytes: it is a budget of
+    file sizes, the parsed documents use several times more memory.
+    """
+
+    def __init__(self, maxBytes=64 << 20):
+        self.maxBytes = maxBytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # (path, load function, loader) -> (stamp, document, size)
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def load(self, fn, load, loader=None):
+        """return a copy of load(fn) or load(fn, loader), using the cached one if fn did not change"""
+        stamp = fileStamp(fn)
+        key = (os.path.abspath(fn), load, loader)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == stamp:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return copyDocument(entry[1])
+            self.misses += 1
+        doc = load(fn) if loader is None else load(fn, loader)
+        if stamp is None:
+            return doc
+        size = stamp[1]
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[2]
+            if size <= self.maxBytes:
+                self._entries[key] = (stamp, copyDocument(doc), size)
+                self.size += size
+                while self.size > self.maxBytes:
+                    _, (_, _, evicted) = self._entries.popitem(last=False)
+                    self.size -= evicted
+        return doc
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
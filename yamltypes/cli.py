@@ -1,27 +1,69 @@
-from .yamlconfig import YamlConfig, YamlError
 import argparse
 import sys
 
+# the validation machinery is only imported once the arguments are parsed, so that
+# --help, and --client when the server runs, stay fast
+
+
 def columnSeparatedPath(s):
     return s.split(":")
 
 
+def validateLocally(fns, meta, path, sample=None):
+    from .yamlconfig import YamlConfig, YamlError
+    for fn in fns:
+        try:
+            YamlConfig(fn, specfn=meta, yamltypes_dirs=path, sample=sample)
+            yield fn, None
+        except YamlError as e:
+            yield fn, str(e)
+
+
 def main():
     parser = argparse.ArgumentParser(description='Validate yamlconfigs')
     parser.add_argument('--meta',
                         help='meta file to use to validate the yaml files', default=None)
     parser.add_argument('--path', type=columnSeparatedPath,
                         help='List of directories where to find meta.yaml files', default=[])
-    parser.add_argument('yamls', nargs='+',
+    parser.add_argument('--server', action='store_true',
+                        help='run a validation server, keeping the compiled specs in memory')
+    parser.add_argument('--client', action='store_true',
+                        help='validate using the server if it runs, locally otherwise')
+    parser.add_argument('--socket', default=None,
+                        help='unix socket of the validation server '
+                        '(default: $XDG_RUNTIME_DIR/yamlvalidate-<uid>.sock)')
+    parser.add_argument('--sample', type=int, default=None, metavar='N',
+                        help='only validate N elements, chosen deterministically, of each '
+                        'listof and mapof collection which has more (for quick local checks, '
+                        'the full validation should still run in CI)')
+    parser.add_argument('yamls', nargs='*',
                         help='files to validate')
 
     args = parser.parse_args()
-    ret = 0
-    for fn in args.yamls:
+    if args.server:
+        from .server import serve
+        serve(args.socket)
+        return 0
+    if not args.yamls:
+        parser.error("the following arguments are required: yamls")
+    if args.sample is not None and args.sample < 1:
+        parser.error("--sample must be at least 1")
+    results = None
+    if args.client:
+        import socket
+        from .client import validateWithServer
         try:
-            YamlConfig(fn, specfn=args.meta, yamltypes_dirs=args.path)
+            results = list(validateWithServer(args.yamls, args.meta, args.path,
+                                              path=args.socket, sample=args.sample))
+        except socket.error:
+            pass
+    if results is None:
+        results = validateLocally(args.yamls, args.meta, args.path, args.sample)
+    ret = 0
+    for fn, error in results:
+        if error is None:
             print(fn, "looks good!")
-        except YamlError as e:
-            print(e.message, file=sys.stderr)
+        else:
+            print(error, file=sys.stderr)
             ret = 1
     return ret
@@ -0,0 +1,40 @@
+"""Thin client of the validation server (see server.py)
+
+It only uses the standard library, so that ``yamlvalidate --client`` does not pay for
+importing PyYAML and compiling the specs.
+"""
+from __future__ import absolute_import
+
+import json
+import os
+import socket
+
+
+def defaultSocketPath():
+    basedir = os.environ.get("XDG_RUNTIME_DIR")
+    if not basedir:
+        import tempfile
+        basedir = tempfile.gettempdir()
+    return os.path.join(basedir, "yamlvalidate-%d.sock" % (os.getuid(),))
+
+
+def validateWithServer(fns, meta=None, yamltypes_dirs=None, path=None, sample=None):
+    """send the files to the server, and yield (fn, error) as the answers arrive
+    raises socket.error if the server is not running
+    """
+    if path is None:
+        path = defaultSocketPath()
+    absfns = dict((os.path.abspath(fn), fn) for fn in fns)
+    request = dict(files=list(absfns),
+                   meta=meta and os.path.abspath(meta),
+                   path=[os.path.abspath(p) for p in yamltypes_dirs or []],
+                   sample=sample)
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+        s.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        for line in s.makefile("rb"):
+            answer = json.loads(line.decode("utf-8"))
+            yield absfns[answer["file"]], answer["error"]
+    finally:
+        s.close()
@@ -0,0 +1,98 @@
+"""Validation daemon used by ``yamlvalidate --server``
+
+Starting a python interpreter and compiling the specs costs much more than validating
+a file. The server keeps the compiled specs in memory, and validates the files sent by
+``yamlvalidate --client`` (see client.py) on a local unix socket.
+
+The protocol is one json request per connection, terminated by a newline::
+
+    {"files": ["/abs/path/a.yaml"], "meta": null, "path": ["/abs/dir"], "sample": null}
+
+answered by one json line per file::
+
+    {"file": "/abs/path/a.yaml", "ok": false, "error": "..."}
+"""
+from __future__ import absolute_import
+
+import json
+import os
+import socket
+import socketserver
+import sys
+
+from .cache import SpecCache
+from .client import defaultSocketPath
+from .yamlconfig import YamlConfigBuilder
+from .yamlconfig import findSpec
+
+
+class ValidationServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+    def __init__(self, path, specCache=None, limits=None):
+        if specCache is None:
+            specCache = SpecCache()
+        self.specCache = specCache
+        # limits of the loaded documents, see yaml.limitedLoader
+        self.limits = limits
+        _removeStaleSocket(path)
+        socketserver.UnixStreamServer.__init__(self, path, ValidationHandler)
+
+    def validate(self, fn, meta=None, yamltypes_dirs=None, sample=None):
+        """validate one file, return None or the error message"""
+        if not yamltypes_dirs:
+            yamltypes_dirs = [os.path.dirname(os.path.abspath(fn))]
+        try:
+            specfn = meta or findSpec(fn, yamltypes_dirs)
+            if specfn is None:
+                raise ValueError("no spec found for %s" % (fn, ))
+            spec = self.specCache.get(specfn, yamltypes_dirs)
+            YamlConfigBuilder(fn, spec=spec, yamltypes_dirs=yamltypes_dirs, limits=self.limits,
+                              sample=sample)
+        except Exception as e:
+            return str(e)
+        return None
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+class ValidationHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        request = json.loads(self.rfile.readline().decode("utf-8"))
+        for fn in request["files"]:
+            error = self.server.validate(fn, request.get("meta"), request.get("path"),
+                                         request.get("sample"))
+            answer = dict(file=fn, ok=error is None, error=error)
+            self.wfile.write(json.dumps(answer).encode("utf-8") + b"\n")
+
+
+def _removeStaleSocket(path):
+    if not os.path.exists(path):
+        return
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+    except socket.error:
+        os.unlink(path)
+    else:
+        raise RuntimeError("a server is already listening on %s" % (path,))
+    finally:
+        s.close()
+
+
+def serve(path=None, limits=None):
+    if path is None:
+        path = defaultSocketPath()
+    server = ValidationServer(path, limits=limits)
+    print("yamlvalidate server listening on", path, file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,269 @@
+"""validated configs shared between processes
+
+A pre-fork server loads and validates its configs once, and publishes them in a file::
+
+    publishConfig(YamlConfig("product.yaml"), "/run/app/product.config")
+
+The workers map that file, and get a read-only view of the config, whose nodes are
+decoded on access. The file is mapped read-only and shared, so the memory does not grow
+with the number of workers, and no refcount touches the pages of the config::
+
+    cfg = openSharedConfig("/run/app/product.config")
+    cfg.slaves.l1site.caps.speed
+
+The file is a header followed by the nodes, each container pointing to its items by
+their offsets in the file.
+"""
+from __future__ import absolute_import
+
+import mmap
+import os
+import pickle
+import struct
+import tempfile
+from collections.abc import Mapping
+from collections.abc import Sequence
+
+MAGIC = b"YTSC"
+VERSION = 1
+
+_header = struct.Struct("<4sIQ")
+_count = struct.Struct("<I")
+_int = struct.Struct("<q")
+_float = struct.Struct("<d")
+_offset = struct.Struct("<Q")
+_entry = struct.Struct("<QQ")
+
+
+class _Encoder(object):
+
+    def __init__(self):
+        self.out = bytearray(_header.size)
+
+    def encode(self, v):
+        """append v and its items, return the offset of v"""
+        if isinstance(v, dict):
+            entries = [(self.encode(k), self.encode(i)) for k, i in v.items()]
+            data = b"d" + _count.pack(len(entries)) + b"".join(
+                _entry.pack(k, i) for k, i in entries)
+        elif isinstance(v, (list, tuple)):
+            items = [self.encode(i) for i in v]
+            data = b"l" + _count.pack(len(items)) + b"".join(_offset.pack(i) for i in items)
+        elif v is None:
+            data = b"N"
+        elif v is True:
+            data = b"T"
+        elif v is False:
+            data = b"F"
+        elif type(v) is int and -2 ** 63 <= v < 2 ** 63:
+            data = b"i" + _int.pack(v)
+        elif type(v) is float:
+            data = b"f" + _float.pack(v)
+        elif type(v) is str:
+            s = v.encode("utf-8")
+            data = b"s" + _count.pack(len(s)) + s
+        else:
+            # big integers, arrays, etc.
+            s = pickle.dumps(v, pickle.HIGHEST_PROTOCOL)
+            data = b"p" + _count.pack(len(s)) + s
+        offset = len(self.out)
+        self.out += data
+        return offset
+
+
+def dumpsConfig(cfg):
+    """serialize cfg (a Namespace, or any json like object) in the shared config format"""
+    encoder = _Encoder()
+    root = encoder.encode(cfg)
+    encoder.out[:_header.size] = _header.pack(MAGIC, VERSION, root)
+    return bytes(encoder.out)
+
+
+def publishConfig(cfg, fn):
+    """write cfg to the file fn, atomically replacing it"""
+    data = dumpsConfig(cfg)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fn)), prefix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, fn)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def openSharedConfig(fn):
+    """map the file written by publishConfig, and return the view of its root"""
+    with open(fn, "rb") as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return loadsConfig(buf)
+
+
+def loadsConfig(buf):
+    """return the view of the root of a serialized config (bytes, mmap, ...)"""
+    magic, version, root = _header.unpack_from(buf, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("not a shared config, or of another version: %r %r" % (magic, version))
+    return _decode(buf, root)
+
+
+def _decodeKid(buf, kids, offset):
+    """decode the item of a view at offset, kids being the containers the view decoded"""
+    try:
+        return kids[offset]
+    except KeyError:
+        pass
+    v = _decode(buf, offset)
+    if isinstance(v, (SharedNamespace, SharedList)):
+        # keep the view, so that its index is not built again on the next access
+        kids[offset] = v
+    return v
+
+
+def _decode(buf, offset):
+    tag = buf[offset:offset + 1]
+    offset += 1
+    if tag == b"d":
+        return SharedNamespace(buf, offset)
+    if tag == b"l":
+        return SharedList(buf, offset)
+    if tag == b"s":
+        n, = _count.unpack_from(buf, offset)
+        offset += _count.size
+        return bytes(buf[offset:offset + n]).decode("utf-8")
+    if tag == b"i":
+        return _int.unpack_from(buf, offset)[0]
+    if tag == b"f":
+        return _float.unpack_from(buf, offset)[0]
+    if tag == b"N":
+        return None
+    if tag == b"T":
+        return True
+    if tag == b"F":
+        return False
+    if tag == b"p":
+        n, = _count.unpack_from(buf, offset)
+        offset += _count.size
+        return pickle.loads(buf[offset:offset + n])
+    raise ValueError("corrupted shared config, unknown node %r" % (tag,))
+
+
+def toPython(v):
+    """return a plain copy of a shared view: dicts and lists"""
+    if isinstance(v, SharedNamespace):
+        return dict((k, toPython(i)) for k, i in v.items())
+    if isinstance(v, SharedList):
+        return [toPython(i) for i in v]
+    return v
+
+
+class SharedNamespace(Mapping):
+
+    """read-only Namespace like view of a serialized dict
+
+    The keys are decoded on first access, the scalar values each time they are accessed.
+    The views of the dicts and lists it holds are kept once decoded.
+    """
+
+    # the internal attributes are private, so that they do not hide the keys of the config
+    __slots__ = ('__buf', '__offset', '__index', '__kids')
+
+    def __init__(self, buf, offset):
+        object.__setattr__(self, '_SharedNamespace__buf', buf)
+        object.__setattr__(self, '_SharedNamespace__offset', offset)
+        object.__setattr__(self, '_SharedNamespace__index', None)
+        object.__setattr__(self, '_SharedNamespace__kids', None)
+
+    def __getIndex(self):
+        index = self.__index
+        if index is None:
+            buf = self.__buf
+            n, = _count.unpack_from(buf, self.__offset)
+            start = self.__offset + _count.size
+            index = {}
+            for i in range(n):
+                k, v = _entry.unpack_from(buf, start + i * _entry.size)
+                index[_decode(buf, k)] = v
+            object.__setattr__(self, '_SharedNamespace__index', index)
+        return index
+
+    def __getitem__(self, k):
+        kids = self.__kids
+        if kids is None:
+            kids = {}
+            object.__setattr__(self, '_SharedNamespace__kids', kids)
+        return _decodeKid(self.__buf, kids, self.__getIndex()[k])
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except KeyError as e:
+            raise AttributeError(e)
+
+    def __setattr__(self, name, value):
+        raise TypeError("shared configs are read-only")
+
+    __setitem__ = __delitem__ = __delattr__ = __setattr__
+
+    def __iter__(self):
+        return iter(self.__getIndex())
+
+    def __len__(self):
+        return _count.unpack_from(self.__buf, self.__offset)[0]
+
+    def __contains__(self, k):
+        return k in self.__getIndex()
+
+    def __repr__(self):
+        return "SharedNamespace(%r)" % (toPython(self),)
+
+    def __reduce__(self):
+        return (dict, (toPython(self),))
+
+
+class SharedList(Sequence):
+
+    """read-only view of a serialized list, its scalar items are decoded each time they are
+    accessed, and the views of its dicts and lists kept once decoded"""
+
+    __slots__ = ('_buf', '_offset', '_kids')
+
+    def __init__(self, buf, offset):
+        self._buf = buf
+        self._offset = offset
+        self._kids = None
+
+    def __len__(self):
+        return _count.unpack_from(self._buf, self._offset)[0]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError("list index out of range")
+        offset, = _offset.unpack_from(self._buf, self._offset + _count.size + i * _offset.size)
+        if self._kids is None:
+            self._kids = {}
+        return _decodeKid(self._buf, self._kids, offset)
+
+    def __eq__(self, other):
+        if not isinstance(other, (list, tuple, SharedList)):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    def __ne__(self, other):
+        ret = self.__eq__(other)
+        return ret if ret is NotImplemented else not ret
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "SharedList(%r)" % (toPython(self),)
+
+    def __reduce__(self):
+        return (list, (toPython(self),))
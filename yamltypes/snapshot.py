@@ -0,0 +1,117 @@
+"""snapshots of validated configs
+
+Loading a config parses its data, customizations and spec files, applies the
+customizations, compiles the spec and matches the result. A snapshot keeps the final
+validated config in a binary file, used instead while none of the files it was built
+from changed::
+
+    cfg = YamlConfig("product.yaml", customizations=["site.yaml"], snapshotDir="/var/cache/app")
+
+Snapshots are named after a hash of the arguments of the builder and of the version of
+yamltypes, and hold the hash of the content of each file the config was built from: the
+data file, the customizations and the ones they import, the spec and its type imports.
+The files which were looked for but did not exist, like the specs more specific than the
+one which was found, are recorded without a hash, so that creating them invalidates the
+snapshot too.
+They are pickles: the snapshot directory must only be writable by trusted users.
+"""
+from __future__ import absolute_import
+
+import hashlib
+import inspect
+import os
+import pickle
+import tempfile
+
+from .cache import recordingBuilder
+
+# version of the format of the snapshots
+SNAPSHOT_VERSION = 1
+
+_packageVersion = None
+
+
+def packageVersion():
+    global _packageVersion
+    if _packageVersion is None:
+        try:
+            from importlib.metadata import version
+            _packageVersion = version("yamltypes")
+        except Exception:
+            # not installed, e.g. running from a checkout
+            _packageVersion = "unknown"
+    return _packageVersion
+
+
+def fileHash(fn):
+    """sha256 of the content of fn, None if it does not exist"""
+    h = hashlib.sha256()
+    try:
+        with open(fn, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+    except (IOError, OSError):
+        return None
+    return h.hexdigest()
+
+
+def snapshotKey(builderClass, args, kw):
+    """hash of what identifies a config: the arguments of its builder and the versions"""
+    arguments = inspect.signature(builderClass.__init__).bind(None, *args, **kw).arguments
+    arguments.pop("self")
+    arguments.pop("fileCache", None)
+    arguments["fn"] = os.path.abspath(arguments["fn"])
+    arguments["customizations"] = [os.path.abspath(fn)
+                                   for fn in arguments.get("customizations") or []]
+    spec = arguments.get("spec")
+    if spec is not None:
+        # the content of the spec is checked with the files
+        arguments["spec"] = os.path.abspath(spec.specfn)
+    key = (builderClass.__module__, builderClass.__name__, sorted(arguments.items()),
+           packageVersion(), SNAPSHOT_VERSION)
+    return hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+
+
+def readSnapshot(fn):
+    """return the config of the snapshot fn, or None if it is missing or outdated"""
+    try:
+        with open(fn, "rb") as f:
+            files = pickle.load(f)
+            if any(fileHash(source) != h for source, h in files):
+                return None
+            return pickle.load(f)
+    except Exception:
+        # truncated, or written by an incompatible version
+        return None
+
+
+def writeSnapshot(fn, sources, config):
+    """atomically write the snapshot of config, built from the files sources"""
+    files = [(source, fileHash(source)) for source in sources]
+    dirname = os.path.dirname(os.path.abspath(fn))
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(files, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(config, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, fn)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def loadConfig(builderClass, snapshotDir, *args, **kw):
+    """return builderClass(*args, **kw)._ns, from its snapshot in snapshotDir if it is up to date"""
+    fn = os.path.join(snapshotDir, snapshotKey(builderClass, args, kw) + ".snapshot")
+    config = readSnapshot(fn)
+    if config is not None:
+        return config
+    builder = recordingBuilder(builderClass)(*args, **kw)
+    sources = list(builder.loaded)
+    if builder.spec is not None:
+        sources.extend(builder.spec.sources)
+    sources.extend(builder.missing)
+    if not os.path.isdir(snapshotDir):
+        os.makedirs(snapshotDir)
+    writeSnapshot(fn, sources, builder._ns)
+    return builder._ns
@@ -14,19 +14,55 @@
 # Copyright Buildbot Team Members
 from __future__ import absolute_import
 
+import array
+import asyncio
+import copy
+import datetime
+import io
 import os
-
+import pickle
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from .. import aio
+from .. import cache
+from .. import client
+from .. import server
+from .. import shared
+from .. import snapshot
+from .. import watch
 from .. import yaml
+from .. import yaml2rst
 
+from collections import OrderedDict
 from dictns import Namespace
 from textwrap import dedent
 from unittest import TestCase
 
 from ..yamlconfig import OrderedYamlConfig
 from ..yamlconfig import YamlConfig
+from ..yamlconfig import Dict
 from ..yamlconfig import findSpec
+from ..yamlconfig import FrozenNamespace
+from ..yamlconfig import Type
 from ..yamlconfig import YamlConfigBuilder
+from ..yamlconfig import YamlError
+from ..yamlconfig import YamlSpec
+from ..yamlconfig import ValidationRecord
+from ..yamlconfig import createType
+from ..yamlconfig import OrderedYamlSpec
 from ..yamlconfig import _parseYaml
+from ..yamlconfig import orderedYamlLoad
+from ..yamlconfig import sampleIndexes
+from ..yamlconfig import yamlLoad
+from ..yamlconfig import internType
+from ..yamlconfig import List
 
 
 class BaseTestCase(TestCase):
@@ -191,6 +227,1227 @@ class TestYamlConfig(BaseTestCase):
                       customizations=["complex.customization.fail"])
 
 
+def dbFile(fn):
+    return os.path.join(os.path.dirname(__file__), "test_db", "yaml_config", fn)
+
+
+class TestAsyncYamlConfig(BaseTestCase):
+
+    def test_load(self):
+        y = asyncio.run(aio.AsyncYamlConfig(dbFile("basic.yaml")))
+        self.assertEqual(y.field1, "OK")
+
+    def test_load_ordered(self):
+        y = asyncio.run(aio.AsyncOrderedYamlConfig(dbFile("basic.yaml")))
+        self.assertEqual(y.field1, "OK")
+
+    def test_validate_many(self):
+        fns = [dbFile("basic.yaml"), dbFile("complex.yaml")] * 5
+        res = asyncio.run(aio.validateConfigs(fns, concurrency=2,
+                                              additionnal_types=dbFile("types.meta.yaml")))
+        self.assertEqual(len(res), 10)
+        self.assertEqual(res[0].field1, "OK")
+        self.assertEqual(res[1].slaves.l4site.caps.speed, "fast")
+
+    def test_validate_many_error(self):
+        fns = [dbFile("basic.yaml"), dbFile("basic.fail1.yaml")]
+        self.assertRaisesWithMessage(
+            ValueError, "Key 'field2' not defined in spec file",
+            asyncio.run, aio.validateConfigs(fns, specfn=dbFile("basic.meta.yaml")))
+
+    def test_validate_many_return_exceptions(self):
+        fns = [dbFile("basic.yaml"), dbFile("basic.fail1.yaml")]
+        res = asyncio.run(aio.validateConfigs(fns, specfn=dbFile("basic.meta.yaml"),
+                                              return_exceptions=True))
+        self.assertEqual(res[0].field1, "OK")
+        self.assertTrue(isinstance(res[1], ValueError))
+
+
+class TestYamlSpec(BaseTestCase):
+
+    def test_validate_object(self):
+        spec = YamlSpec(dbFile("complex.meta.yaml"), additionnal_types=dbFile("types.meta.yaml"))
+        y = spec.validate(_parseYaml(open(dbFile("complex.yaml")).read()))
+        self.assertEqual(y.slaves.l4site.caps.speed, "fast")
+
+    def test_validate_string(self):
+        spec = YamlSpec(dbFile("basic.meta.yaml"))
+        self.assertEqual(spec.validate("field1: OK").field1, "OK")
+        self.assertEqual(spec.validate(b'{"field1": "OK"}').field1, "OK")
+
+    def test_validate_errors(self):
+        spec = YamlSpec(dbFile("basic.meta.yaml"))
+        self.assertRaisesWithMessage(
+            ValueError, "basic: Key 'field2' not defined in spec file, should be one of: ['field1']",
+            spec.validate, dict(field2="KO"))
+        self.assertRaisesWithMessage(ValueError, "doc.field1: 'KO' should be one of: OK",
+                                     spec.validate, "field1: KO", name="doc")
+        self.assertRaisesWithMessage(ValueError, "found already in-use key",
+                                     spec.validate, "field1: OK\nfield1: OK")
+
+    def test_validate_string_safe(self):
+        for specClass in (YamlSpec, OrderedYamlSpec):
+            spec = specClass(dbFile("basic.meta.yaml"))
+            with mock.patch("os.getpid") as getpid:
+                self.assertRaisesWithMessage(
+                    ValueError, "could not determine a constructor for the tag",
+                    spec.validate, "field1: !!python/object/apply:os.getpid []")
+            self.assertFalse(getpid.called)
+
+    def test_from_root(self):
+        types = YamlSpec(dbFile("complex.meta.yaml"), additionnal_types=dbFile("types.meta.yaml")).types
+        spec = YamlSpec.fromRoot(dict(type="dict", kids=dict(loc=dict(type="location"))), "doc", types)
+        self.assertEqual(spec.validate("loc: l1").loc, "l1")
+        self.assertRaisesWithMessage(ValueError, "doc.loc: 'l9' should be one of",
+                                     spec.validate, dict(loc="l9"))
+        self.assertEqual((spec.specfn, spec.sources), (None, []))
+
+    def test_spec_reused_by_builders(self):
+        spec = YamlSpec(dbFile("basic.meta.yaml"))
+        self.assertEqual(YamlConfig(dbFile("basic.yaml"), spec=spec).field1, "OK")
+        self.assertRaisesWithMessage(ValueError, "basic.fail2.field1: 'KO' should be one of: OK",
+                                     YamlConfig, dbFile("basic.fail2.yaml"), spec=spec)
+
+    def test_builder_hooks(self):
+        # the spec compiled by a builder loads its files and compiles its types through it
+        loaded = []
+        created = []
+
+        class Builder(YamlConfigBuilder):
+            def _yamlLoad(self, fn):
+                loaded.append(os.path.basename(fn))
+                return YamlConfigBuilder._yamlLoad(self, fn)
+
+            def createType(self, path, name, spec):
+                created.append(path)
+                return YamlConfigBuilder.createType(self, path, name, spec)
+        b = Builder(dbFile("complex.yaml"), additionnal_types=dbFile("types.meta.yaml"))
+        self.assertEqual(b._ns.slaves.l4site.caps.speed, "fast")
+        self.assertEqual(loaded, ["complex.yaml", "types.meta.yaml", "complex.meta.yaml"])
+        self.assertEqual(created, ["types.meta.yaml:location", "complex"])
+        self.assertIs(b.types, b.spec.types)
+        self.assertIn("location", b.types)
+
+    def test_conditions_before_defaults(self):
+        # conditions see the document before the defaults are filled, whatever the key order
+        spec = YamlSpec.fromRoot(dict(type="dict", kids=dict(
+            a=dict(type="dict", kids=dict(x=dict(type="integer", default=1))),
+            b=dict(type="dict", kids=dict(y=dict(type="integer", required="'x' in self.a"))))),
+            "doc")
+        self.assertEqual(spec.validate(OrderedDict([("a", {}), ("b", {})])).a.x, 1)
+        self.assertEqual(spec.validate(OrderedDict([("b", {}), ("a", {})])).a.x, 1)
+        self.assertRaisesWithMessage(ValueError, "doc.b: needs to define the option 'y'",
+                                     spec.validate, OrderedDict([("a", dict(x=2)), ("b", {})]))
+
+
+class TestRevalidate(BaseTestCase):
+
+    def setUp(self):
+        self.spec = YamlSpec(dbFile("complex.meta.yaml"),
+                             additionnal_types=dbFile("types.meta.yaml"))
+        self.doc = _parseYaml(open(dbFile("complex.yaml")).read())
+        self.spec.validate(self.doc)
+
+    def test_valid_change(self):
+        caps = self.doc["slaves"]["l4site"]["caps"]
+        caps["speed"] = "slow"
+        del caps["speed"]
+        self.spec.revalidate(self.doc, ["slaves.l4site.caps.speed"])
+        # defaults are filled again
+        self.assertEqual(caps["speed"], "fast")
+
+    def test_invalid_value(self):
+        self.doc["slaves"]["l4site"]["caps"]["speed"] = "KO"
+        self.assertRaisesWithMessage(
+            ValueError, "complex.slaves.l4site.caps.speed: 'KO' should be one of: fast, slow",
+            self.spec.revalidate, self.doc, [("slaves", "l4site", "caps", "speed")])
+
+    def test_deleted_required(self):
+        del self.doc["slaves"]["l4site"]["caps"]["location"]
+        self.assertRaisesWithMessage(
+            ValueError, "complex.slaves.l4site.caps: needs to define the option 'location'",
+            self.spec.revalidate, self.doc, ["slaves.l4site.caps.location"])
+
+    def test_unknown_key(self):
+        self.doc["slaves"]["l4site"]["foo"] = 1
+        self.assertRaisesWithMessage(
+            ValueError, "complex.slaves.l4site: Key 'foo' not defined in spec file",
+            self.spec.revalidate, self.doc, ["slaves.l4site.foo"])
+
+    def test_duplicate_in_set(self):
+        builder = self.doc["slaves"]["l4site"]["caps"]["builder"]
+        builder[:] = ["build", "build"]
+        self.assertRaisesWithMessage(
+            ValueError, "is included several times in a set",
+            self.spec.revalidate, self.doc, ["slaves.l4site.caps.builder.1"])
+
+    def test_conditions(self):
+        spec = YamlSpec(dbFile("conditionnal_required.meta.yaml"))
+        doc = dict(mode="notrequired")
+        record = ValidationRecord()
+        spec.validate(doc, record=record)
+        doc["mode"] = "required"
+        self.assertRaisesWithMessage(
+            ValueError, "conditionnal_required: needs to define the option 'field1'",
+            spec.revalidate, doc, ["mode"], record=record)
+        self.assertRaisesWithMessage(ValueError, "needs the ValidationRecord of its validation",
+                                     spec.revalidate, doc, ["mode"])
+
+    def test_conditions_before_defaults(self):
+        spec = YamlSpec.fromRoot(dict(type="dict", kids=dict(
+            a=dict(type="dict", kids=dict(x=dict(type="integer", default=1))),
+            b=dict(type="dict", kids=dict(y=dict(type="integer", required="'x' in self.a"))))),
+            "doc")
+        doc = dict(a={}, b={})
+        record = ValidationRecord()
+        spec.validate(doc, record=record)
+        spec.revalidate(doc, ["a"], record=record)
+        # set by the changes, it is not a default anymore
+        doc["a"]["x"] = 2
+        self.assertRaisesWithMessage(ValueError, "doc.b: needs to define the option 'y'",
+                                     spec.revalidate, doc, ["a.x"], record=record)
+
+    def itemsSpec(self):
+        spec = YamlSpec.fromRoot(dict(type="dict", kids=dict(
+            mode=dict(type="string"),
+            items=dict(type="mapofdicts", kids=dict(
+                y=dict(type="integer", required="self.mode == 'strict'"),
+                z=dict(type="integer", default=0))))), "doc")
+        doc = dict(mode="loose", items=dict(("i%d" % i, dict(z=i)) for i in range(1000)))
+        record = ValidationRecord()
+        spec.validate(doc, record=record)
+        return spec, doc, record
+
+    def test_conditions_incremental(self):
+        spec, doc, record = self.itemsSpec()
+        doc["items"]["i5"]["z"] = 6
+        with mock.patch.object(Dict, "check_conditionals", autospec=True,
+                               side_effect=Dict.check_conditionals) as check:
+            with mock.patch("yamltypes.yamlconfig.toNamespace") as toNamespace:
+                spec.revalidate(doc, ["items.i5.z"], record=record)
+        self.assertEqual(check.call_count, 1)
+        self.assertFalse(toNamespace.called)
+        doc["mode"] = "strict"
+        self.assertRaisesWithMessage(ValueError, "doc.items.i0: needs to define the option 'y'",
+                                     spec.revalidate, doc, ["mode"], record=record)
+
+    def test_deleted_not_rematched(self):
+        spec, doc, record = self.itemsSpec()
+        del doc["items"]["i5"]
+        del doc["items"]["i6"]["z"]
+        with mock.patch.object(Dict, "iter_steps", autospec=True,
+                               side_effect=Dict.iter_steps) as iter_steps:
+            spec.revalidate(doc, ["items.i5", "items.i6.z"], record=record)
+        self.assertFalse(iter_steps.called)
+        self.assertEqual(doc["items"]["i6"], dict(z=0))
+
+
+class TestArrays(BaseTestCase):
+
+    def setUp(self):
+        self.spec = YamlSpec.fromRoot(dict(type="dict", kids=dict(
+            ints=dict(type="listofintegers"),
+            floats=dict(type="mapofdicts", kids=dict(values=dict(type="listoffloats"))),
+            nulls=dict(type="listofintegers"),
+            strings=dict(type="listofstrings"))), "doc")
+
+    def doc(self):
+        return dict(ints=[1, 2, 3], floats=dict(a=dict(values=[1.5]), b=dict(values=[])), nulls=[1, None],
+                    strings=["a"])
+
+    def test_array(self):
+        y = self.spec.validate(self.doc(), arrays="array")
+        self.assertEqual(y.ints, array.array("q", [1, 2, 3]))
+        self.assertEqual(y.floats.a["values"], array.array("d", [1.5]))
+        self.assertEqual(y.floats.b["values"], array.array("d"))
+        self.assertEqual(y.nulls, [1, None])
+        self.assertEqual(y.strings, ["a"])
+
+    def test_default_is_lists(self):
+        self.assertEqual(self.spec.validate(self.doc()).ints, [1, 2, 3])
+
+    def test_numpy(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("numpy is not installed")
+        y = self.spec.validate(self.doc(), arrays=True)
+        self.assertIsInstance(y.ints, numpy.ndarray)
+        self.assertEqual(y.ints.dtype, numpy.int64)
+
+    def test_bad_option(self):
+        self.assertRaisesWithMessage(ValueError, "arrays should be one of",
+                                     self.spec.validate, self.doc(), arrays="list")
+        self.assertRaisesWithMessage(ValueError, "are not supported in lazy mode",
+                                     self.spec.validate, self.doc(), lazy=True, arrays=True)
+
+
+class TestIntern(BaseTestCase):
+
+    def test_keys(self):
+        loader = yaml.interningLoader(yaml.DuplicateCheckLoader, yaml.InternTable())
+        self.assertIs(loader, yaml.interningLoader(yaml.DuplicateCheckLoader, loader.internTable))
+        a = yaml.load("".join(["key", "_a: 1"]), Loader=loader)
+        b = yaml.load("key_a: 2", Loader=loader)
+        self.assertIs(list(a)[0], list(b)[0])
+
+    def test_values(self):
+        table = yaml.InternTable(["".join(["fa", "st"])], maxsize=2)
+        table.update(["slow", "other", "more"])
+        self.assertEqual(len(table), 2)
+        loader = yaml.interningLoader(yaml.SafeOrderedMapAndDuplicateCheckLoader, table)
+        y = yaml.load("a: fast\nb: [fast, slow, other]", Loader=loader)
+        self.assertIs(y["a"], y["b"][0])
+        self.assertIs(y["b"][1], table.intern("slow"))
+        self.assertEqual(y["b"][2], "other")
+        self.assertEqual(list(y), ["a", "b"])
+
+    def test_builder(self):
+        fn = dbFile("complex.yaml")
+        kw = dict(additionnal_types=dbFile("types.meta.yaml"), intern=True)
+        a = YamlConfig(fn, **kw)
+        b = YamlConfig(fn, **kw)
+        self.assertIs(a.slaves.l1site.caps.speed, b.slaves.l1site.caps.speed)
+        self.assertIs(a.slaves.l4site.caps.builder[0], b.slaves.l4site.caps.builder[0])
+        spec = YamlSpec(dbFile("complex.meta.yaml"), additionnal_types=dbFile("types.meta.yaml"))
+        self.assertTrue({"fast", "slow", "autolint", "build"}.issubset(spec.stringValues()))
+
+
+class TestSharedConfig(BaseTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.fn = os.path.join(self.tmpdir, "complex.config")
+        self.cfg = YamlConfig(dbFile("complex.yaml"), additionnal_types=dbFile("types.meta.yaml"))
+
+    def test_roundtrip(self):
+        shared.publishConfig(self.cfg, self.fn)
+        y = shared.openSharedConfig(self.fn)
+        self.assertEqual(y, self.cfg)
+        self.assertEqual(y.slaves.l1site.caps.speed, "fast")
+        self.assertEqual(y.slaves.l1site.slaves[-1], "build5build")
+        self.assertEqual(sorted(y.slaves), ["l1site", "l4site"])
+        self.assertEqual(shared.toPython(y), self.cfg)
+        self.assertRaises(AttributeError, getattr, y, "foo")
+
+    def test_scalars(self):
+        doc = dict(a=[None, True, False, 1, -2 ** 70, 1.5, "\xe9", (1, 2)],
+                   b=array.array("q", [1, 2]), c={1: "one"})
+        y = shared.loadsConfig(shared.dumpsConfig(doc))
+        self.assertEqual(shared.toPython(y), dict(doc, a=doc["a"][:-1] + [[1, 2]]))
+        self.assertEqual(y.a[1:3], [True, False])
+
+    def test_read_only(self):
+        y = shared.loadsConfig(shared.dumpsConfig(self.cfg))
+        self.assertRaises(TypeError, setattr, y, "slaves", 1)
+        self.assertRaises(TypeError, y.__setitem__, "slaves", 1)
+
+        def assign():
+            y.slaves.l1site.slaves[0] = 1
+        self.assertRaises(TypeError, assign)
+
+    def test_internal_names(self):
+        doc = dict((k, k + "!") for k in ("_buf", "_offset", "_index", "_kids", "_getIndex"))
+        y = shared.loadsConfig(shared.dumpsConfig(dict(d=doc)))
+        for k in doc:
+            self.assertEqual(getattr(y.d, k), k + "!")
+
+    def test_large_map(self):
+        doc = dict(big=dict(("k%d" % i, dict(v=i)) for i in range(20000)))
+        y = shared.loadsConfig(shared.dumpsConfig(doc))
+        start = time.time()
+        for i in range(0, 20000, 5):
+            self.assertEqual(y.big["k%d" % i].v, i)
+        self.assertLess(time.time() - start, 5)
+        self.assertIs(y.big, y.big)
+
+    def test_bad_file(self):
+        self.assertRaisesWithMessage(ValueError, "not a shared config",
+                                     shared.loadsConfig, b"YAML" + b"\0" * 12)
+
+
+class TestFrozenConfig(BaseTestCase):
+
+    def setUp(self):
+        self.cfg = YamlConfig(dbFile("complex.yaml"), additionnal_types=dbFile("types.meta.yaml"),
+                              frozen=True)
+
+    def test_frozen(self):
+        self.assertIsInstance(self.cfg, FrozenNamespace)
+        self.assertIsInstance(self.cfg, Namespace)
+        caps = self.cfg.slaves.l1site.caps
+        self.assertEqual(caps.builder, ("autolint", "build"))
+        self.assertEqual(caps.speed, "fast")
+        self.assertRaises(TypeError, setattr, caps, "speed", "slow")
+        self.assertRaises(TypeError, caps.__setitem__, "speed", "slow")
+        self.assertRaises(TypeError, caps.update, speed="slow")
+        self.assertRaises(TypeError, caps.pop, "speed")
+
+    def test_hashable(self):
+        other = YamlConfig(dbFile("complex.yaml"), additionnal_types=dbFile("types.meta.yaml"),
+                           frozen=True)
+        self.assertEqual(hash(self.cfg), hash(other))
+        self.assertEqual(len({self.cfg, other}), 1)
+
+    def test_copies(self):
+        self.assertIs(copy.deepcopy(self.cfg), self.cfg)
+        self.assertIs(self.cfg.copy(), self.cfg)
+        y = pickle.loads(pickle.dumps(self.cfg))
+        self.assertIsInstance(y.slaves, FrozenNamespace)
+        self.assertEqual(y, self.cfg)
+
+    def test_internal_names(self):
+        # the keys are not hidden by the attributes of the FrozenNamespaces
+        names = ["_hash", "_readOnly"]
+        spec = YamlSpec.fromRoot(dict(type="dict", kids=dict(
+            (k, dict(type="string")) for k in names)), "doc")
+        y = spec.validate(dict((k, k) for k in names), frozen=True)
+        self.assertEqual([getattr(y, k) for k in names], names)
+        self.assertEqual(hash(y), hash(spec.validate(dict((k, k) for k in names), frozen=True)))
+
+    def test_arrays(self):
+        self.assertRaisesWithMessage(ValueError, "arrays is not supported with frozen",
+                                     YamlConfig, dbFile("complex.yaml"),
+                                     additionnal_types=dbFile("types.meta.yaml"),
+                                     frozen=True, arrays="array")
+
+
+class TestConfigHandle(BaseTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        for fn in ("basic.yaml", "basic.meta.yaml"):
+            shutil.copy(dbFile(fn), self.tmpdir)
+        self.fn = os.path.join(self.tmpdir, "basic.yaml")
+        self.custom = os.path.join(self.tmpdir, "custom.yaml")
+        self.write(self.custom, "basic.yaml:\n  field1: OK\n")
+        self.handle = watch.ConfigHandle(self.fn, customizations=[self.custom], interval=0.01)
+        self.events = []
+        self.handle.subscribe(lambda handle, cfg: self.events.append(cfg),
+                              lambda handle, e: self.events.append(e))
+
+    def write(self, fn, content):
+        with open(fn, "w") as f:
+            f.write(content)
+
+    def test_unchanged(self):
+        self.assertEqual(self.handle.config.field1, "OK")
+        self.assertFalse(self.handle.check())
+        self.assertEqual(self.events, [])
+
+    def test_invalid_change(self):
+        cfg = self.handle.config
+        self.write(self.custom, "basic.yaml:\n  field1: KO\n")
+        self.assertFalse(self.handle.check())
+        self.assertIs(self.handle.config, cfg)
+        self.assertIn("'KO' should be one of: OK", str(self.handle.lastError))
+        self.assertEqual(self.events, [self.handle.lastError])
+        # not retried until the next change
+        self.assertFalse(self.handle.changed())
+
+    def test_spec_change(self):
+        spec = self.handle.builder.spec
+        self.write(self.fn, "field1: OK\n# comment\n")
+        self.assertTrue(self.handle.check())
+        self.assertIs(self.handle.builder.spec, spec)
+        self.write(os.path.join(self.tmpdir, "basic.meta.yaml"), dedent("""
+            root:
+              type: dict
+              kids:
+                field1:
+                  type: string
+                  values: [OK, KO]
+            """))
+        self.write(self.custom, "basic.yaml:\n  field1: KO\n")
+        self.assertTrue(self.handle.check())
+        self.assertIsNot(self.handle.builder.spec, spec)
+        self.assertEqual(self.handle.config.field1, "KO")
+        self.assertEqual(self.events, [dict(field1="OK"), dict(field1="KO")])
+
+    def test_created_spec(self):
+        fn = os.path.join(self.tmpdir, "foo.basic.yaml")
+        self.write(fn, "field1: OK\n")
+        handle = watch.ConfigHandle(fn, additionnal_types=os.path.join(self.tmpdir, "t.meta.yaml"))
+        self.assertFalse(handle.check())
+        self.write(os.path.join(self.tmpdir, "t.meta.yaml"), "other:\n  type: string\n")
+        self.assertTrue(handle.check())
+        self.write(os.path.join(self.tmpdir, "foo.basic.meta.yaml"),
+                   "root:\n  type: dict\n  kids:\n    field1: {type: string, values: [KO]}\n")
+        self.assertFalse(handle.check())
+        self.assertIn("'OK' should be one of: KO", str(handle.lastError))
+
+    def test_background(self):
+        with self.handle:
+            self.write(self.custom, "basic.yaml:\n  field1: OK\n# changed\n")
+            for i in range(500):
+                if self.events:
+                    break
+                time.sleep(0.01)
+        self.assertEqual(self.events, [self.handle.config])
+
+
+class TestLoaderLimits(BaseTestCase):
+
+    laughs = dedent("""
+        a: &a [x, x, x, x, x, x, x, x, x, x]
+        b: &b [*a, *a, *a, *a, *a, *a, *a, *a, *a, *a]
+        c: &c [*b, *b, *b, *b, *b, *b, *b, *b, *b, *b]
+        d: &d [*c, *c, *c, *c, *c, *c, *c, *c, *c, *c]
+        """)
+
+    def load(self, content, **limits):
+        return yaml.load(content, Loader=yaml.limitedLoader(yaml.DuplicateCheckLoader, **limits))
+
+    def test_unlimited(self):
+        self.assertEqual(len(self.load(self.laughs)["d"]), 10)
+        self.assertIs(yaml.limitedLoader(yaml.DuplicateCheckLoader, maxNodes=1),
+                      yaml.limitedLoader(yaml.DuplicateCheckLoader, maxNodes=1))
+
+    def test_nodes(self):
+        self.assertEqual(len(self.load(self.laughs, maxNodes=20000)["d"]), 10)
+        self.assertRaisesWithMessage(yaml.LimitExceededError,
+                                     "document exceeds the limit of 10000 nodes",
+                                     self.load, self.laughs, maxNodes=10000)
+
+    def test_aliases(self):
+        self.assertRaisesWithMessage(yaml.LimitExceededError,
+                                     "document exceeds the limit of 25 aliases",
+                                     self.load, self.laughs, maxAliases=25)
+
+    def test_depth(self):
+        self.assertEqual(self.load("[[[1]]]", maxDepth=4), [[[1]]])
+        self.assertRaisesWithMessage(yaml.LimitExceededError,
+                                     "document exceeds the nesting limit of 3",
+                                     self.load, "[[[1]]]", maxDepth=3)
+
+    def test_recursive(self):
+        self.assertRaisesWithMessage(yaml.LimitExceededError, "recursive aliases",
+                                     self.load, "&a [*a]", maxDepth=100)
+
+    def test_bytes(self):
+        self.assertRaisesWithMessage(yaml.LimitExceededError,
+                                     "document of 15 bytes exceeds the limit of 10 bytes",
+                                     self.load, "field1: OK, KO]", maxBytes=10)
+        with open(dbFile("complex.yaml")) as f:
+            self.assertRaisesWithMessage(yaml.LimitExceededError, "exceeds the limit of 10 bytes",
+                                         self.load, f, maxBytes=10)
+
+    def test_encoded_bytes(self):
+        self.assertEqual(self.load("a: \xe9\xe9", maxBytes=10), dict(a="\xe9\xe9"))
+        self.assertRaisesWithMessage(yaml.LimitExceededError,
+                                     "document of 11 bytes exceeds the limit of 10 bytes",
+                                     self.load, "a: \xe9\xe9\xe9\xe9", maxBytes=10)
+
+    def test_file_not_read(self):
+        loader = yaml.limitedLoader(yaml.DuplicateCheckLoader, maxBytes=10)
+        f = open(dbFile("complex.yaml"))
+        self.addCleanup(f.close)
+        wrapper = mock.MagicMock(wraps=f)
+        wrapper.__enter__.return_value = wrapper
+        with mock.patch("yamltypes.yamlconfig.open", create=True, return_value=wrapper):
+            self.assertRaisesWithMessage(YamlError, "exceeds the limit of 10 bytes",
+                                         yamlLoad, dbFile("complex.yaml"), loader)
+        self.assertFalse(wrapper.read.called)
+        if os.path.exists("/dev/zero"):
+            # its size is unknown, it is only read up to the limit
+            self.assertRaisesWithMessage(YamlError, "exceeds the limit of 10 bytes",
+                                         yamlLoad, "/dev/zero", loader)
+
+    def test_builder(self):
+        kw = dict(additionnal_types=dbFile("types.meta.yaml"))
+        YamlConfig(dbFile("complex.yaml"), limits=dict(maxNodes=100), **kw)
+        self.assertRaisesWithMessage(YamlError, "complex.yaml: document exceeds the limit of 10 nodes",
+                                     YamlConfig, dbFile("complex.yaml"), limits=dict(maxNodes=10),
+                                     **kw)
+
+
+class TestParsedFileCache(BaseTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.fn = os.path.join(self.tmpdir, "a.yaml")
+        self.write(self.fn, "a: [1, 2]\n")
+        self.cache = cache.ParsedFileCache()
+
+    def write(self, fn, content):
+        with open(fn, "w") as f:
+            f.write(content)
+
+    def test_isolated(self):
+        a = self.cache.load(self.fn, yamlLoad)
+        a["a"].append(3)
+        b = self.cache.load(self.fn, yamlLoad)
+        self.assertEqual(b, dict(a=[1, 2]))
+        b["a"].append(4)
+        self.assertEqual(self.cache.load(self.fn, yamlLoad), dict(a=[1, 2]))
+        self.assertEqual((self.cache.hits, self.cache.misses), (2, 1))
+
+    def test_isolated_values(self):
+        def load(fn):
+            return dict(s=set([1, 2]), t=(1, [2]), a=[[1], {"b": 2}], d=datetime.date(2020, 1, 1))
+        a = self.cache.load(self.fn, load)
+        a["s"].add(3)
+        a["t"][1].append(3)
+        a["a"][0].append(3)
+        b = self.cache.load(self.fn, load)
+        self.assertEqual(b, load(self.fn))
+        self.assertIs(b["d"], self.cache.load(self.fn, load)["d"])
+
+    def test_ordered(self):
+        self.write(self.fn, "b: 1\na: [{d: 1, c: 2}]\n")
+        self.cache.load(self.fn, orderedYamlLoad)
+        a = self.cache.load(self.fn, orderedYamlLoad)
+        self.assertEqual(list(a), ["b", "a"])
+        self.assertEqual(list(a["a"][0]), ["d", "c"])
+
+    def test_key(self):
+        self.cache.load(self.fn, yamlLoad)
+        self.cache.load(self.fn, orderedYamlLoad)
+        self.cache.load(self.fn, yamlLoad, yaml.SafeDuplicateCheckLoader)
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 3))
+        self.write(self.fn, "a: [1, 2, 3]\n")
+        self.assertEqual(self.cache.load(self.fn, yamlLoad), dict(a=[1, 2, 3]))
+        self.assertEqual(len(self.cache), 3)
+        self.assertEqual(self.cache.size, 10 * 2 + 13)
+
+    def test_eviction(self):
+        self.cache.maxBytes = 15
+        other = os.path.join(self.tmpdir, "b.yaml")
+        self.write(other, "b: [1, 2]\n")
+        self.cache.load(self.fn, yamlLoad)
+        self.cache.load(other, yamlLoad)
+        self.assertEqual(len(self.cache), 1)
+        self.cache.load(other, yamlLoad)
+        self.assertEqual(self.cache.hits, 1)
+        self.cache.load(self.fn, yamlLoad)
+        self.assertEqual(self.cache.misses, 3)
+
+    def test_builders(self):
+        kw = dict(additionnal_types=dbFile("types.meta.yaml"), fileCache=self.cache)
+        customizations = [dbFile("complex.customization.yaml")]
+        for i in range(3):
+            y = YamlConfig(dbFile("complex.yaml"), customizations=customizations, **kw)
+            self.assertEqual(y.slaves.l3site.caps.location, "l3")
+        # data, customization, spec and types
+        self.assertEqual(self.cache.misses, 4)
+        self.assertEqual(self.cache.hits, 8)
+        y = OrderedYamlConfig(dbFile("complex.yaml"), **kw)
+        self.assertEqual(self.cache.misses, 7)
+
+
+class TestSnapshot(BaseTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        for fn in ("complex.yaml", "complex.meta.yaml", "types.meta.yaml",
+                   "complex.customization.yaml"):
+            shutil.copy(dbFile(fn), self.tmpdir)
+        self.snapshotDir = os.path.join(self.tmpdir, "snapshots")
+        self.fn = os.path.join(self.tmpdir, "complex.yaml")
+        self.kw = dict(customizations=[os.path.join(self.tmpdir, "complex.customization.yaml")],
+                       additionnal_types=os.path.join(self.tmpdir, "types.meta.yaml"),
+                       snapshotDir=self.snapshotDir)
+
+    def load(self, **kw):
+        return YamlConfig(self.fn, **dict(self.kw, **kw))
+
+    def test_snapshot(self):
+        y = self.load()
+        self.assertEqual(y.slaves.l3site.caps.location, "l3")
+        self.assertEqual(len(os.listdir(self.snapshotDir)), 1)
+        with mock.patch.object(snapshot, "recordingBuilder", side_effect=AssertionError):
+            self.assertEqual(self.load(), y)
+            self.assertIsInstance(self.load().slaves, Namespace)
+
+    def test_invalidated(self):
+        self.load()
+        for fn in ("complex.yaml", "complex.meta.yaml", "types.meta.yaml",
+                   "complex.customization.yaml"):
+            with open(os.path.join(self.tmpdir, fn), "a") as f:
+                f.write("\n# changed\n")
+            with mock.patch.object(snapshot, "recordingBuilder", side_effect=AssertionError(fn)):
+                self.assertRaisesWithMessage(AssertionError, fn, self.load)
+            self.load()
+
+    def test_created_files(self):
+        # the files looked for are checked too: a more specific spec, and the types
+        shutil.copy(dbFile("basic.meta.yaml"), self.tmpdir)
+        fn = os.path.join(self.tmpdir, "foo.basic.yaml")
+        types = os.path.join(self.tmpdir, "more.meta.yaml")
+        with open(fn, "w") as f:
+            f.write("field1: OK\n")
+        kw = dict(snapshotDir=self.snapshotDir, additionnal_types=types)
+        self.assertEqual(YamlConfig(fn, **kw).field1, "OK")
+        with open(types, "w") as f:
+            f.write("other:\n  type: string\n")
+        with mock.patch.object(snapshot, "recordingBuilder", side_effect=AssertionError("types")):
+            self.assertRaisesWithMessage(AssertionError, "types", YamlConfig, fn, **kw)
+        self.assertEqual(YamlConfig(fn, **kw).field1, "OK")
+        with open(os.path.join(self.tmpdir, "foo.basic.meta.yaml"), "w") as f:
+            f.write("root:\n  type: dict\n  kids:\n    field1: {type: string, values: [KO]}\n")
+        self.assertRaisesWithMessage(ValueError, "'OK' should be one of: KO", YamlConfig, fn, **kw)
+
+    def test_key(self):
+        self.load()
+        self.load(frozen=True)
+        OrderedYamlConfig(self.fn, **self.kw)
+        self.assertEqual(len(os.listdir(self.snapshotDir)), 3)
+        with mock.patch.object(snapshot, "_packageVersion", "0.0"):
+            self.load()
+        self.assertEqual(len(os.listdir(self.snapshotDir)), 4)
+
+    def test_corrupted(self):
+        self.load()
+        fn, = os.listdir(self.snapshotDir)
+        with open(os.path.join(self.snapshotDir, fn), "wb") as f:
+            f.write(b"garbage")
+        self.assertEqual(self.load().slaves.l3site.caps.location, "l3")
+
+
+class TestLazyDefaults(BaseTestCase):
+
+    def setUp(self):
+        self.spec = YamlSpec.fromRoot(dict(type="mapofdicts", kids=dict(
+            speed=dict(type="string", default="fast"),
+            tags=dict(type="listofstrings", default=["a"]),
+            mode=dict(type="string", required='"speed" in self.e1'))), "doc")
+
+    def test_view(self):
+        doc = dict(e1=dict(speed="slow", mode="x"), e2=dict(mode="y"))
+        y = self.spec.validate(doc, lazyDefaults=True)
+        self.assertEqual(doc["e2"], dict(mode="y"))
+        self.assertEqual(y.e2.speed, "fast")
+        self.assertEqual(y.e2["speed"], "fast")
+        self.assertEqual(y.e2.get("speed"), "fast")
+        self.assertIn("speed", y.e2)
+        self.assertEqual(sorted(y.e2), ["mode", "speed", "tags"])
+        self.assertEqual(len(y.e2), 3)
+        self.assertEqual(y, self.spec.validate(dict(e1=dict(speed="slow", mode="x"),
+                                                    e2=dict(mode="y"))))
+        self.assertEqual(pickle.loads(pickle.dumps(y)), y)
+        self.assertRaises(AttributeError, getattr, y.e2, "other")
+
+    def test_not_shared(self):
+        y = self.spec.validate(dict(e1=dict(), e2=dict()), lazyDefaults=True)
+        y.e1.tags.append("b")
+        self.assertEqual(y.e2.tags, ["a"])
+        y.e2.speed = "slow"
+        self.assertEqual(y.e1.speed, "fast")
+
+    def test_materialize(self):
+        y = self.spec.validate(dict(e1=dict()), lazyDefaults=True)
+        self.assertEqual(dict.__len__(y.e1), 0)
+        y.materialize()
+        self.assertEqual(dict(dict.items(y.e1)), dict(speed="fast", tags=["a"]))
+
+    def test_conditions_without_defaults(self):
+        # the conditions see the document without its defaults, like in the other modes
+        for kw in [{}, dict(lazyDefaults=True), dict(lazy=True)]:
+            self.assertEqual(self.spec.validate(dict(e1=dict()), **kw).e1.speed, "fast")
+            # in lazy mode, e1 is only matched when it is accessed
+            self.assertRaisesWithMessage(
+                ValueError, "doc.e1: needs to define the option 'mode'",
+                lambda: self.spec.validate(dict(e1=dict(speed="slow")), **kw).e1)
+
+    def test_internal_names(self):
+        # the keys are not hidden by the attributes of the view
+        names = ["_type", "_spec_of", "_defaults", "_missingDefaults"]
+        spec = YamlSpec.fromRoot(dict(type="dict", kids=dict(
+            (k, dict(type="string", default=k)) for k in names)), "doc")
+        for doc in [{}, dict((k, k) for k in names)]:
+            y = spec.validate(doc, lazyDefaults=True)
+            self.assertEqual([getattr(y, k) for k in names], names)
+
+    def test_builder(self):
+        y = YamlConfig(dbFile("complex.yaml"), additionnal_types=dbFile("types.meta.yaml"),
+                       lazyDefaults=True)
+        self.assertNotIn("speed", dict.keys(y.slaves.l4site.caps))
+        self.assertEqual(y.slaves.l4site.caps.speed, "fast")
+
+
+class TestSample(BaseTestCase):
+
+    def setUp(self):
+        self.spec = YamlSpec.fromRoot(dict(type="dict", kids=dict(
+            name=dict(type="string", required=True),
+            hosts=dict(type="listofdicts", kids=dict(port=dict(type="integer"))),
+            sites=dict(type="mapofdicts", kids=dict(port=dict(type="integer"))),
+            ports=dict(type="listofintegers"))), "doc")
+
+    def doc(self):
+        return dict(name="x", hosts=[dict(port=i) for i in range(100)],
+                    sites=dict(("s%d" % i, dict(port=i)) for i in range(100)),
+                    ports=list(range(100)))
+
+    def test_sampleIndexes(self):
+        self.assertEqual(sampleIndexes("doc.hosts", 100, 5), sampleIndexes("doc.hosts", 100, 5))
+        self.assertNotEqual(sampleIndexes("doc.hosts", 100, 5),
+                            sampleIndexes("doc.sites", 100, 5))
+        self.assertEqual(len(set(sampleIndexes("doc.hosts", 100, 5))), 5)
+
+    def test_sampled_out(self):
+        bad = [i for i in range(100) if i not in sampleIndexes("doc.hosts", 100, 5)][0]
+        doc = self.doc()
+        doc["hosts"][bad]["port"] = "x"
+        self.spec.validate(doc, sample=5)
+        self.assertRaises(ValueError, self.spec.validate, doc)
+
+    def test_sampled_in(self):
+        bad = sampleIndexes("doc.hosts", 100, 5)[0]
+        doc = self.doc()
+        doc["hosts"][bad]["port"] = "x"
+        self.assertRaises(ValueError, self.spec.validate, doc, sample=5)
+
+    def test_not_sampled(self):
+        # scalar collections, small collections and the other keys are always checked
+        doc = self.doc()
+        doc["ports"][50] = "x"
+        self.assertRaises(ValueError, self.spec.validate, doc, sample=5)
+        doc = self.doc()
+        del doc["name"]
+        self.assertRaisesWithMessage(ValueError, "doc: needs to define the option 'name'",
+                                     self.spec.validate, doc, sample=5)
+        doc = self.doc()
+        doc["hosts"] = [dict(port=1), dict(port="x")]
+        self.assertRaises(ValueError, self.spec.validate, doc, sample=2)
+
+    def test_lazy(self):
+        self.assertRaises(ValueError, self.spec.validate, self.doc(), lazy=True, sample=5)
+
+
+class TestLazyConfig(BaseTestCase):
+
+    def openYaml(self, fn):
+        return YamlConfig(dbFile(fn), specfn=dbFile("complex.meta.yaml"),
+                          additionnal_types=dbFile("types.meta.yaml"), lazy=True)
+
+    def test_valid(self):
+        y = self.openYaml("complex.yaml")
+        self.assertEqual(y.slaves.l4site.caps.speed, "fast")
+        self.assertEqual(y.slaves['l4site'].slaves, ['buildbot1build'])
+        self.assertTrue(isinstance(y, Namespace))
+        self.assertEqual(y, YamlConfig(dbFile("complex.yaml"),
+                                       additionnal_types=dbFile("types.meta.yaml")))
+
+    def test_validated_on_access(self):
+        y = self.openYaml("complex.fail1.yaml")
+        self.assertEqual(y.slaves.l3site.caps.location, "l3")
+        self.assertEqual(y.slaves.l123site.caps.speed, "fast")
+        self.assertRaisesWithMessage(ValueError, "slaves.l123site.caps.location: 'l123' should be one of",
+                                     lambda: y.slaves.l123site.caps.location)
+        # still invalid on next access
+        self.assertRaisesWithMessage(ValueError, "'l123' should be one of",
+                                     lambda: y.slaves.l123site.caps['location'])
+
+    def test_validate_all(self):
+        y = self.openYaml("complex.fail3.yaml")
+        self.assertRaisesWithMessage(ValueError, "needs to define the option 'location'",
+                                     y.validate_all)
+
+    def test_internal_names(self):
+        # the keys are not hidden by the attributes of the lazy Namespaces
+        names = ["_type", "_path", "_ctx", "_pending", "_validated", "_wrap"]
+        spec = YamlSpec.fromRoot(dict(type="dict", kids=dict(
+            [(k, dict(type="string")) for k in names] +
+            [("b", dict(type="string", required="self._ctx == 'c'"))])), "doc")
+        doc = dict((k, k) for k in names)
+        for kw in [{}, dict(lazy=True)]:
+            y = spec.validate(dict(doc), **kw)
+            self.assertEqual([getattr(y, k) for k in names], names)
+        self.assertRaisesWithMessage(ValueError, "doc: needs to define the option 'b'",
+                                     spec.validate, dict(doc, _ctx="c"), lazy=True)
+
+    def test_root_checked_eagerly(self):
+        self.assertRaisesWithMessage(
+            ValueError, "Key 'field2' not defined in spec file",
+            YamlConfig, dbFile("basic.fail1.yaml"), specfn=dbFile("basic.meta.yaml"), lazy=True)
+        self.assertRaisesWithMessage(
+            ValueError, "needs to define the option 'field1'",
+            YamlConfig, dbFile("conditionnal_required.fail1.yaml"),
+            specfn=dbFile("conditionnal_required.meta.yaml"), lazy=True)
+
+    def test_mutation(self):
+        y = self.openYaml("complex.fail1.yaml")
+        y.slaves.l123site = dict(caps=dict(location="l1"))
+        self.assertEqual(y.slaves.l123site.caps.location, "l1")
+        self.assertEqual(sorted(y.slaves.keys()), ['l123site', 'l3site'])
+
+    def test_conditions(self):
+        # the conditions see the document without its defaults, and without copying it
+        spec = YamlSpec.fromRoot(dict(type="dict", kids=dict(
+            a=dict(type="dict", kids=dict(x=dict(type="integer", default=1))),
+            b=dict(type="dict", kids=dict(y=dict(type="integer", required="'x' in self.a"))))),
+            "doc")
+        def toNamespace(val):
+            self.assertNotIsInstance(val, dict)
+            return val
+        with mock.patch("yamltypes.yamlconfig.toNamespace", toNamespace):
+            y = spec.validate(OrderedDict([("a", {}), ("b", {})]), lazy=True)
+            self.assertEqual(y.b, {})
+            y = spec.validate(OrderedDict([("a", {}), ("b", {})]), lazy=True)
+            y.a.validate_all()
+            self.assertEqual(y.b, {})
+            y = spec.validate(OrderedDict([("a", dict(x=2)), ("b", {})]), lazy=True)
+            self.assertRaisesWithMessage(ValueError, "doc.b: needs to define the option 'y'",
+                                         getattr, y, "b")
+
+
+class TestValidationServer(BaseTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for fn in "basic.yaml basic.fail2.yaml basic.meta.yaml".split():
+            shutil.copy(dbFile(fn), self.tmpdir)
+        self.socket = os.path.join(self.tmpdir, "server.sock")
+        self.server = server.ValidationServer(self.socket)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(self.tmpdir)
+
+    def validate(self, *fns):
+        fns = [os.path.join(self.tmpdir, fn) for fn in fns]
+        meta = os.path.join(self.tmpdir, "basic.meta.yaml")
+        return dict((os.path.basename(fn), error) for fn, error in
+                    client.validateWithServer(fns, meta=meta, path=self.socket))
+
+    def test_validate(self):
+        res = self.validate("basic.yaml", "basic.fail2.yaml")
+        self.assertEqual(res["basic.yaml"], None)
+        self.assertIn("'KO' should be one of: OK", res["basic.fail2.yaml"])
+
+    def test_spec_cached(self):
+        self.validate("basic.yaml")
+        self.validate("basic.yaml")
+        self.assertEqual(len(self.server.specCache._specs), 1)
+
+    def test_spec_invalidated(self):
+        self.validate("basic.yaml")
+        specfn = os.path.join(self.tmpdir, "basic.meta.yaml")
+        with open(specfn, "w") as f:
+            f.write("root:\n  type: dict\n  kids:\n    field1:\n      type: string\n")
+        self.assertEqual(self.validate("basic.fail2.yaml")["basic.fail2.yaml"], None)
+
+    def test_server_not_running(self):
+        self.assertRaises(socket.error, list,
+                          client.validateWithServer(["basic.yaml"],
+                                                    path=os.path.join(self.tmpdir, "nope")))
+
+
+class TestLazyImports(BaseTestCase):
+    # imported on first use only, as importing PyYAML alone takes tens of milliseconds
+    LAZY_MODULES = ("yaml", "logging", "yamltypes.yaml")
+
+    def checkImport(self, module):
+        code = ("import sys; import {}; print(' '.join(m for m in {!r} if m in sys.modules))"
+                .format(module, self.LAZY_MODULES))
+        rootdir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        p = subprocess.Popen([sys.executable, "-c", code], cwd=rootdir,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = p.communicate()
+        self.assertEqual(p.returncode, 0, err)
+        self.assertEqual(out.decode().split(), [])
+
+    def test_yamlconfig(self):
+        self.checkImport("yamltypes.yamlconfig")
+
+    def test_package(self):
+        self.checkImport("yamltypes")
+
+    def test_cli(self):
+        self.checkImport("yamltypes.cli")
+
+    def test_yaml2rst(self):
+        self.checkImport("yamltypes.yaml2rst")
+
+
+class TestYaml2Rst(BaseTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for d, fns in [("p1", ["basic.meta.yaml", "complex.meta.yaml"]),
+                       ("p2", ["conditionnal_required.meta.yaml"])]:
+            os.mkdir(os.path.join(self.tmpdir, d))
+            for fn in fns:
+                shutil.copy(dbFile(fn), os.path.join(self.tmpdir, d))
+        self.types = sorted(yaml2rst.BASE_TYPES.items())
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def render(self, d, dumpTypes):
+        outfn = os.path.join(self.tmpdir, d + ".rst")
+        yaml2rst.renderDirectory(os.path.join(self.tmpdir, d), outfn, self.types, dumpTypes)
+        with open(outfn) as f:
+            return f.read()
+
+    def test_render(self):
+        rst = self.render("p1", True)
+        self.assertIn("YAML documentation for the product 'p1'", rst)
+        self.assertIn(".. _p1_integer:", rst)
+        self.assertIn(".. _p1_file_type_complex.yaml:", rst)
+        self.assertIn("            **Type:** set of :ref:`p1_string`", rst)
+
+    def test_render_without_types(self):
+        rst = self.render("p2", False)
+        self.assertIn(".. _p2_file_type_conditionnal_required.yaml:", rst)
+        self.assertFalse(".. _p2_integer:" in rst)
+
+    def runMain(self):
+        argv = ["yaml2rst", os.path.join(self.tmpdir, "p1"), os.path.join(self.tmpdir, "p2"),
+                "--output", self.tmpdir, "-j", "1"]
+        rendered = []
+
+        def render(d, *args):
+            rendered.append(os.path.basename(d))
+            return renderDirectory(d, *args)
+        renderDirectory = yaml2rst.renderDirectory
+        with mock.patch.object(sys, "argv", argv), \
+                mock.patch.object(yaml2rst, "renderDirectory", render):
+            yaml2rst.main()
+        return rendered
+
+    def test_incremental(self):
+        self.assertEqual(self.runMain(), ["p1", "p2"])
+        self.assertEqual(self.runMain(), [])
+        with open(os.path.join(self.tmpdir, "p2", "conditionnal_required.meta.yaml"), "a") as f:
+            f.write("\n# comment\n")
+        self.assertEqual(self.runMain(), ["p2"])
+        os.unlink(os.path.join(self.tmpdir, "p1.rst"))
+        self.assertEqual(self.runMain(), ["p1"])
+
+    def test_unchanged_output_not_rewritten(self):
+        self.render("p1", True)
+        outfn = os.path.join(self.tmpdir, "p1.rst")
+        os.utime(outfn, (0, 0))
+        self.render("p1", True)
+        self.assertEqual(os.stat(outfn).st_mtime, 0)
+
+    def test_safe_load(self):
+        self.assertEqual(yaml.safe_load("a: 1"), {'a': 1})
+        self.assertRaises(yaml.constructor.ConstructorError, yaml.safe_load, "a: 1\na: 2")
+
+
+class TestCompiledTypes(BaseTestCase):
+
+    def createType(self, spec):
+        return createType({}, "root", "root", spec)
+
+    def test_slots(self):
+        t = self.createType(dict(type="dict", kids=dict(a=dict(type="listofstrings"))))
+        self.assertFalse(hasattr(t, "__dict__"))
+        self.assertFalse(hasattr(t.spec['a'], "__dict__"))
+        self.assertFalse(hasattr(t.spec['a'].spec, "__dict__"))
+
+    def test_leaf_interned(self):
+        t = self.createType(dict(type="dict", kids=dict(a=dict(type="string"),
+                                                        b=dict(type="string"),
+                                                        c=dict(type="listofstrings"))))
+        self.assertIs(t.spec['a'], t.spec['b'])
+        self.assertIs(t.spec['a'], t.spec['c'].spec)
+
+    def test_leaf_modifiers_not_shared(self):
+        t = self.createType(dict(type="dict", kids=dict(a=dict(type="string", required=True),
+                                                        b=dict(type="string"),
+                                                        c=dict(type="integer", default=1),
+                                                        d=dict(type="integer", default=True))))
+        self.assertIsNot(t.spec['a'], t.spec['b'])
+        self.assertIsNot(t.spec['c'], t.spec['d'])
+        self.assertEqual(t.spec['a'].required, True)
+        self.assertEqual(t.spec['b'].required, None)
+
+    def test_unhashable_default_not_interned(self):
+        t = Type("string", str, default=[])
+        self.assertIs(internType(t), t)
+
+    def conditionalType(self):
+        return self.createType(dict(type="dict", kids=dict(
+            mode=dict(type="string"),
+            field1=dict(type="string",
+                        required='self.mode=="required"',
+                        forbidden='self.mode=="forbidden"'))))
+
+    def test_conditions_evaluated_per_document(self):
+        t = self.conditionalType()
+        t.match("doc1", dict(mode="required", field1="OK"))
+        t.match("doc2", dict(mode="notrequired"))
+        self.assertRaisesWithMessage(ValueError, "needs to define the option 'field1'",
+                                     t.match, "doc3", dict(mode="required"))
+        self.assertRaisesWithMessage(ValueError, "option field1 is forbidden",
+                                     t.match, "doc4", dict(mode="forbidden", field1="OK"))
+
+    def test_conditions_shared(self):
+        t = self.conditionalType()
+        self.assertIs(t.spec['field1'], self.conditionalType().spec['field1'])
+
+    def test_condition_syntax_error(self):
+        self.assertRaisesWithMessage(
+            ValueError, "issue with python expression in yaml",
+            self.createType, dict(type="dict", kids=dict(a=dict(type="string", required="self.("))))
+
+    def test_optimize(self):
+        t = self.createType(dict(type="dict", kids=dict(
+            a=dict(type="string", required=True, values=["x", "y"]),
+            b=dict(type="string", forbidden=True),
+            c=dict(type="integer", default=3),
+            d=dict(type="string", required="True"))))
+        t.optimize()
+        self.assertEqual(t._required, frozenset(["a"]))
+        self.assertEqual(t._forbidden, frozenset(["b"]))
+        self.assertEqual(t._defaults, (("c", 3),))
+        self.assertEqual([k for k, s in t._conditionals], ["d"])
+        self.assertEqual(t.spec['a']._valueset, frozenset(["x", "y"]))
+        val = dict(a="x", d="z")
+        t.match("doc", val)
+        self.assertEqual(val['c'], 3)
+        self.assertRaisesWithMessage(ValueError, "'z' should be one of: x, y",
+                                     t.match, "doc", dict(a="z", d="z"))
+        self.assertRaisesWithMessage(ValueError, "needs to define the option 'd'",
+                                     t.match, "doc", dict(a="x"))
+
+    def test_first_error_in_spec_order(self):
+        t = self.createType(dict(type="dict", kids=dict(
+            a=dict(type="string", forbidden=True),
+            b=dict(type="string", required=True))))
+        t.optimize()
+        self.assertRaisesWithMessage(ValueError, "option a is forbidden",
+                                     t.match, "doc", dict(a="x"))
+
+    def test_names_type(self):
+        t = self.createType(dict(type="mapofstrings", names_type=dict(type="string",
+                                                                      values=["a"])))
+        t.optimize()
+        t.match("doc", dict(a="x"))
+        self.assertRaisesWithMessage(ValueError, "root_names[1]: 'b' should be one of: a",
+                                     t.match, "doc", dict(a="x", b="y"))
+
+    def test_condition_runtime_error(self):
+        t = self.createType(dict(type="dict", kids=dict(a=dict(type="string",
+                                                               required="self.missing"))))
+        self.assertRaisesWithMessage(ValueError, "issue with python expression in yaml",
+                                     t.match, "doc", {})
+
+    def test_scalar_collections(self):
+        t = self.createType(dict(type="setofstrings", values=["a", "b", "c"]))
+        t.optimize()
+        self.assertTrue(t.spec.match_all(["a", "b", "a"]))
+        self.assertFalse(t.spec.match_all(["a", "d"]))
+        self.assertFalse(t.spec.match_all(["a", 1]))
+        self.assertFalse(t.spec.match_all(["a", ["b"]]))
+        t = self.createType(dict(type="listofstrings", values=["a", "b", "c"]))
+        t.optimize()
+        t.match("doc", ["a", "b", "c"] * 1000)
+        self.assertRaisesWithMessage(ValueError, "doc[3001]: 'd' should be one of",
+                                     t.match, "doc", ["a", "b", "c"] * 1000 + ["a", "d"])
+        t = self.createType(dict(type="mapofstrings"))
+        t.optimize()
+        t.match("doc", dict(a="x", b="y"))
+        self.assertRaisesWithMessage(ValueError, "doc.b: should be of type",
+                                     t.match, "doc", dict(a="x", b=1))
+        t = self.createType(dict(type="listofdicts", kids=dict()))
+        self.assertFalse(t.spec.match_all([{}]))
+
+    def test_deep_document(self):
+        if yaml.Loader.__name__ != "CLoader":
+            self.skipTest("the python yaml parser is recursive")
+        depth = sys.getrecursionlimit() + 100
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        specfn = os.path.join(tmpdir, "deep.meta.yaml")
+        fn = os.path.join(tmpdir, "deep.yaml")
+        spec = '{type: string, values: [leaf]}'
+        doc = 'leaf'
+        for i in range(depth):
+            spec = ('{type: dict, kids: {kid: %s, d: {type: listofintegers, default: [1]}, '
+                    'c: {type: string, required: "True"}}}' % (spec,))
+            doc = '{kid: %s, c: x}' % (doc,)
+        with open(specfn, "w") as f:
+            f.write("root: %s\n" % (spec,))
+        with open(fn, "w") as f:
+            f.write(doc + "\n")
+        spec = YamlSpec(specfn)
+        for kw in [{}, dict(frozen=True), dict(lazyDefaults=True), dict(arrays="array"), dict(lazy=True)]:
+            y = v = YamlConfig(fn, spec=spec, **kw)
+            for i in range(depth):
+                self.assertEqual(list(v.d), [1])
+                v = v.kid
+            self.assertEqual(v, "leaf")
+        YamlConfig(fn, spec=spec, lazy=True).validate_all()
+        y = YamlConfig(fn, spec=spec, lazyDefaults=True).materialize()
+        for i in range(depth):
+            self.assertEqual(dict.__getitem__(y, "d"), [1])
+            y = dict.__getitem__(y, "kid")
+        hash(YamlConfig(fn, spec=spec, frozen=True))
+        obj = yamlLoad(fn)
+        record = ValidationRecord()
+        spec.validate(obj, record=record)
+        del obj["kid"]["kid"]["c"]
+        self.assertRaisesWithMessage(ValueError, "deep.kid.kid: needs to define the option 'c'",
+                                     spec.revalidate, obj, [["kid", "kid", "c"]], record=record)
+        with open(fn, "w") as f:
+            f.write(doc.replace("leaf", "KO") + "\n")
+        self.assertRaisesWithMessage(ValueError, "deep" + ".kid" * depth + ": 'KO' should be one of",
+                                     YamlConfig, fn, spec=spec)
+
+
+class TestYamlError(BaseTestCase):
+
+    def test_message(self):
+        e = YamlError("a.b", dict(c=[1, 2]), "is wrong")
+        self.assertEqual(str(e), "a.b: is wrong\ncode:\nc:\n- 1\n- 2\n\n")
+        self.assertEqual(e.message, "is wrong")
+
+    def test_lazy(self):
+        class Undumpable(object):
+            def __reduce_ex__(self, proto):
+                raise AssertionError("should not be dumped")
+        e = YamlError("a", Undumpable(), lambda: 1 / 0)
+        self.assertEqual(e.path, "a")
+
+    def test_truncated_items(self):
+        e = YamlError("a", dict(l=list(range(1000))), "is wrong")
+        self.assertIn("- 49\n- '... 950 more items'", str(e))
+        e = YamlError("a", dict(("k%04d" % i, i) for i in range(1000)), "is wrong")
+        self.assertIn("'...': 950 more items", str(e))
+
+    def test_truncated_depth(self):
+        value = {}
+        v = value
+        for i in range(100):
+            v['k'] = {}
+            v = v['k']
+        self.assertEqual(str(YamlError("a", value, "is wrong")).count("k:"), YamlError.maxDepth)
+
+    def test_truncated_bytes(self):
+        e = YamlError("a", "x" * 100000, "is wrong")
+        self.assertTrue(len(str(e)) < YamlError.maxBytes + 100)
+        self.assertIn("... truncated", str(e))
+
+    def test_truncated_wide_and_deep(self):
+        level = dict(("k%d" % i, i) for i in range(50))
+        for i in range(5):
+            level = dict(("k%d" % i, level) for i in range(50))
+        start = time.time()
+        e = str(YamlError("a", level, "is wrong"))
+        self.assertLess(time.time() - start, 5)
+        self.assertLess(len(e), YamlError.maxBytes + 100)
+        self.assertIn("more items", e)
+
+    def test_pickle(self):
+        import pickle
+        e = pickle.loads(pickle.dumps(YamlError("a", dict(b=1), lambda: "is wrong")))
+        self.assertEqual(str(e), "a: is wrong\ncode:\nb: 1\n\n")
+        self.assertEqual(e.value, None)
+
+
 class TestFindSpec(BaseTestCase):
     def testFindSpec_basic(self):
         def exists(s):
@@ -409,3 +1666,38 @@ class TestYamlLoader(BaseTestCase):
         self.assertEqual(list(d.keys()), ['b', 'a', 'c', 'z', 'f', 't'])
         self.assertEqual(list(d.t.keys()), ['t1', 't3', 't2'])
     _testOrderedKeysInNamespace.skip = "Namespace doesn't keep OrderedDict"
+
+
+class TestYamlDumper(BaseTestCase):
+
+    content = "b: 1\na:\n- x\n- d: 1\n  c: 2\n"
+
+    def setUp(self):
+        self.ordered = yaml.load(self.content, Loader=yaml.OrderedMapAndDuplicateCheckLoader)
+
+    def test_ordered(self):
+        for d in (self.ordered, OrderedDict(self.ordered), Namespace(self.ordered)):
+            self.assertEqual(yaml.dump(d, Dumper=yaml.OrderedDumper), self.content)
+            self.assertEqual(yaml.dump(d, Dumper=yaml.SafeOrderedDumper), self.content)
+
+    def test_frozen(self):
+        d = YamlConfig(dbFile("complex.yaml"), additionnal_types=dbFile("types.meta.yaml"),
+                       frozen=True)
+        y = yaml.safe_load(yaml.dump(d, Dumper=yaml.SafeOrderedDumper))
+        self.assertEqual(y["slaves"]["l1site"]["slaves"],
+                         ["build3build", "build4build", "build5build"])
+
+    def test_stream(self):
+        for d in (self.ordered, Namespace(self.ordered)):
+            f = io.StringIO()
+            yaml.dumpStream(d, f)
+            self.assertEqual(f.getvalue(), self.content)
+        f = io.StringIO()
+        yaml.dumpStream(dict(b=1, a=[2]), f)
+        self.assertEqual(f.getvalue(), "a:\n- 2\nb: 1\n")
+        f = io.StringIO()
+        yaml.dumpStream((1, dict(a=2)), f)
+        self.assertEqual(f.getvalue(), "- 1\n- a: 2\n")
+        f = io.StringIO()
+        yaml.dumpStream({}, f)
+        self.assertEqual(f.getvalue(), "{}\n")
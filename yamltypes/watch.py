@@ -0,0 +1,164 @@
+"""configs reloaded when their files change
+
+A ConfigHandle loads a config, and polls the files it was built from: the data file, its
+customizations (and their imports), its spec and the types it imports, as well as the
+files which were looked for but did not exist, like the specs more specific than the one
+which was found. When one of them changes, or is created, the config is reloaded and validated again in a background thread, and replaces
+the current one only if it is valid. The spec is only compiled again if one of its files
+changed::
+
+    handle = ConfigHandle("product.yaml", customizations=["site.yaml"], frozen=True)
+    handle.subscribe(lambda handle, cfg: reconfigure(cfg))
+    handle.start()
+    ...
+    handle.config.slaves
+"""
+from __future__ import absolute_import
+
+import logging
+import os
+import threading
+
+from .cache import SpecCache
+from .cache import fileStamp
+from .cache import recordingBuilder
+from .yamlconfig import OrderedYamlConfigBuilder
+from .yamlconfig import YamlConfigBuilder
+from .yamlconfig import specCandidates
+
+log = logging.getLogger(__name__)
+
+
+class ConfigHandle(object):
+
+    """the current valid version of a config, reloaded when its files change
+
+    The keyword arguments are given to the builder. Subscribers are called with
+    (handle, config) after each successful reload, and error subscribers with
+    (handle, exception) when a reload fails, the previous config being kept.
+    """
+
+    builderClass = YamlConfigBuilder
+
+    def __init__(self, fn, customizations=None, specfn=None, yamltypes_dirs=None,
+                 additionnal_types=None, interval=1.0, specCache=None, **kw):
+        if not yamltypes_dirs:
+            yamltypes_dirs = [os.path.dirname(os.path.abspath(fn))]
+        if specCache is None:
+            specCache = SpecCache()
+            specCache.specClass = self.builderClass.specClass
+        self.fn = fn
+        self.customizations = list(customizations or [])
+        self.specfn = specfn
+        self.yamltypes_dirs = yamltypes_dirs
+        self.additionnal_types = additionnal_types
+        self.interval = interval
+        self.specCache = specCache
+        self.kw = kw
+        self.lastError = None
+        self._builderClass = recordingBuilder(self.builderClass)
+        self._subscribers = []
+        self._errorSubscribers = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        # the first load is synchronous, and its errors are raised
+        self._stamps, self.builder = self._build()
+        self._config = self.builder._ns
+
+    @property
+    def config(self):
+        return self._config
+
+    def subscribe(self, callback, onError=None):
+        self._subscribers.append(callback)
+        if onError is not None:
+            self._errorSubscribers.append(onError)
+
+    def unsubscribe(self, callback, onError=None):
+        self._subscribers.remove(callback)
+        if onError is not None:
+            self._errorSubscribers.remove(onError)
+
+    def _build(self):
+        specfn, missing = self.specfn, []
+        if not specfn:
+            specfn, missing = specCandidates(self.fn, self.yamltypes_dirs)
+        if specfn is None:
+            raise ValueError("no spec found for %s" % (self.fn, ))
+        spec = self.specCache.get(specfn, self.yamltypes_dirs, self.additionnal_types)
+        # stamps are taken before loading, so that a change made while
+        # loading triggers another reload
+        stamps = dict((fn, fileStamp(fn)) for fn in [self.fn, specfn] + self.customizations +
+                      spec.sources + spec.missing + missing)
+        builder = self._builderClass(self.fn, customizations=self.customizations, spec=spec,
+                                     yamltypes_dirs=self.yamltypes_dirs, **self.kw)
+        for fn in builder.loaded:
+            stamps.setdefault(fn, fileStamp(fn))
+        return stamps, builder
+
+    def changed(self):
+        """whether one of the files of the config changed since the last load"""
+        return any(fileStamp(fn) != stamp for fn, stamp in self._stamps.items())
+
+    def reload(self):
+        """reload the config, return True if it was valid, and swapped in"""
+        with self._lock:
+            try:
+                stamps, builder = self._build()
+            except Exception as e:
+                # retried on the next change only
+                self._stamps = dict((fn, fileStamp(fn)) for fn in self._stamps)
+                self.lastError = e
+                log.warning("reloading %s failed: %s", self.fn, e)
+                swapped, subscribers, arg = False, list(self._errorSubscribers), e
+            else:
+                self._stamps = stamps
+                self.builder = builder
+                self._config = builder._ns
+                self.lastError = None
+                swapped, subscribers, arg = True, list(self._subscribers), self._config
+        for callback in subscribers:
+            try:
+                callback(self, arg)
+            except Exception:
+                log.exception("subscriber of %s failed", self.fn)
+        return swapped
+
+    def check(self):
+        """reload the config if one of its files changed, return True if it was reloaded"""
+        if self.changed():
+            return self.reload()
+        return False
+
+    def start(self):
+        """poll the files of the config in a background thread"""
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="ConfigHandle(%s)" % (self.fn,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.check()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class OrderedConfigHandle(ConfigHandle):
+
+    builderClass = OrderedYamlConfigBuilder
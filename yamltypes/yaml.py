@@ -53,6 +53,30 @@
 #   yaml_content = yaml.load(file.read(), Loader=yaml.OrderedMapAndDuplicateCheckLoader)
 #
 #
+# To share the strings between all the loaded documents, interning the mapping keys, and the
+# string values registered in the bounded ``yaml.internTable`` (e.g. the ``values`` of a spec)::
+#
+#   yaml.internTable.update(["fast", "slow"])
+#   yaml_content = yaml.load(file.read(), Loader=yaml.interningLoader(yaml.DuplicateCheckLoader))
+#
+#
+# To load untrusted documents, the size of the input, the number of nodes (counting the nodes
+# of the aliased ones each time they are referenced), the nesting depth and the number of
+# aliases can be limited. Exceeding a limit raises a ``yaml.LimitExceededError``::
+#
+#   Loader = yaml.limitedLoader(yaml.SafeDuplicateCheckLoader, maxNodes=100000, maxDepth=50)
+#   yaml_content = yaml.load(file.read(), Loader=Loader)
+#
+#
+# To dump the loaded configs (OrderedDict, Namespace, tuples of frozen configs) with libyaml, keeping
+# the order of their mappings, use the ``yaml.OrderedDumper`` (or ``yaml.SafeOrderedDumper``)::
+#
+#   yaml.dump(config, f, Dumper=yaml.OrderedDumper)
+#
+# ``yaml.dumpStream(config, f)`` does the same, representing the top level items one by one, so
+# that the nodes of the whole document are never in memory at once.
+#
+#
 # Notes:
 #  - This module has been validated on python 2.7 ONLY
 #  - It is intended to be used like yaml, so we inject all the "exports" from the yaml module into
@@ -64,6 +88,8 @@ from __future__ import absolute_import
 
 
 import logging as _logging
+import os as _os
+import sys as _sys
 
 # injecting the yaml content into the current yaml module
 # This causes the pyflakes error:
@@ -82,9 +108,15 @@ except ImportError:
                        'libyaml-dev is installed in your virtual environment')
 
 try:
-    from collections import OrderedDict
+    from yaml import CDumper as _Dumper
+    from yaml import CSafeDumper as _SafeDumper
 except ImportError:
-    from ordereddict import OrderedDict
+    from yaml import Dumper as _Dumper
+    from yaml import SafeDumper as _SafeDumper
+
+from collections import OrderedDict
+
+from dictns import Namespace as _Namespace
 
 class _LastUpdatedOrderedDict(OrderedDict):
 
@@ -107,6 +139,150 @@ class _LastUpdatedOrderedDict(OrderedDict):
     def __repr__(self):
         return dict(self).__repr__()
 
+class InternTable(object):
+
+    '''
+    I am a bounded table of strings shared by all the documents loaded with an interning loader
+      (see ``interningLoader``): the loaded strings equal to one of mine are replaced by it.
+      Once maxsize strings are registered, the new ones are ignored.
+    '''
+
+    def __init__(self, values=(), maxsize=65536):
+        self.maxsize = maxsize
+        self._strings = {}
+        self.update(values)
+
+    def __len__(self):
+        return len(self._strings)
+
+    def update(self, values):
+        for v in values:
+            if len(self._strings) >= self.maxsize:
+                return
+            if isinstance(v, str):
+                self._strings.setdefault(v, v)
+
+    def intern(self, s):
+        return self._strings.get(s, s)
+
+
+# table used by the interning loaders, unless another one is given
+internTable = InternTable()
+_interningLoaders = {}
+
+
+def interningLoader(loader, table=None):
+    '''
+    Return a subclass of the given duplicate check loader, which interns the mapping keys, and
+      the string values found in table (default: ``internTable``)
+    '''
+    if table is None:
+        table = internTable
+    key = (loader, table)
+    if key not in _interningLoaders:
+        _interningLoaders[key] = type("Interning" + loader.__name__, (loader,),
+                                      dict(internKeys=True, internTable=table))
+    return _interningLoaders[key]
+
+
+class LimitExceededError(ConstructorError):
+    pass
+
+
+_limitedLoaders = {}
+
+
+def limitedLoader(loader, maxBytes=None, maxNodes=None, maxDepth=None, maxAliases=None):
+    '''
+    Return a subclass of the given duplicate check loader, which limits the size of the input in
+      bytes, the number of nodes once the aliases are expanded, the nesting depth
+      and the number of aliases of the documents
+    '''
+    limits = dict(maxBytes=maxBytes, maxNodes=maxNodes, maxDepth=maxDepth, maxAliases=maxAliases)
+    key = (loader,) + tuple(sorted(limits.items()))
+    if key not in _limitedLoaders:
+        _limitedLoaders[key] = type("Limited" + loader.__name__, (loader,), limits)
+    return _limitedLoaders[key]
+
+
+def _streamSize(stream, maxBytes):
+    if isinstance(stream, bytes):
+        return len(stream)
+    if isinstance(stream, str):
+        # the utf-8 encoding of a character is 1 to 4 bytes long
+        if len(stream) > maxBytes or len(stream) * 4 <= maxBytes:
+            return len(stream)
+        return len(stream.encode("utf-8"))
+    try:
+        return _os.fstat(stream.fileno()).st_size - stream.tell()
+    except (AttributeError, OSError, ValueError):
+        # not a file, its size is not known before reading it
+        return None
+
+
+def checkSize(loader, stream):
+    '''
+    Raise a LimitExceededError if the stream is bigger than the maxBytes of the loader. Files
+      are checked without being read, from their size, the other streams are not.
+    '''
+    if loader.maxBytes is None:
+        return
+    size = _streamSize(stream, loader.maxBytes)
+    if size is not None and size > loader.maxBytes:
+        raise LimitExceededError(None, None, "document of %d bytes exceeds the limit of %d bytes"
+                                 % (size, loader.maxBytes), None)
+
+
+def _nodeChildren(node):
+    if isinstance(node, MappingNode):
+        return [n for pair in node.value for n in pair]
+    if isinstance(node, SequenceNode):
+        return node.value
+    return ()
+
+
+def _checkLimits(loader, root):
+    '''
+    Check the limits of the loader on the graph of nodes of a document, before constructing it.
+      The nodes of the aliased nodes are counted each time they are referenced, like they are
+      walked by the validation.
+    '''
+    if loader.maxNodes is None and loader.maxDepth is None and loader.maxAliases is None:
+        return
+    # id(node) -> (number of nodes, depth) of the finished nodes
+    finished = {}
+    visiting = set()
+    aliases = 0
+    stack = [(root, False)]
+    while stack:
+        node, done = stack.pop()
+        children = _nodeChildren(node)
+        if done:
+            visiting.discard(id(node))
+            size = 1 + sum(finished[id(c)][0] for c in children)
+            depth = 1 + max([finished[id(c)][1] for c in children] or [0])
+            finished[id(node)] = (size, depth)
+            if loader.maxNodes is not None and size > loader.maxNodes:
+                raise LimitExceededError(None, None, "document exceeds the limit of %d nodes"
+                                         % (loader.maxNodes,), node.start_mark)
+            if loader.maxDepth is not None and depth > loader.maxDepth:
+                raise LimitExceededError(None, None, "document exceeds the nesting limit of %d"
+                                         % (loader.maxDepth,), node.start_mark)
+            continue
+        if id(node) in finished:
+            aliases += 1
+            if loader.maxAliases is not None and aliases > loader.maxAliases:
+                raise LimitExceededError(None, None, "document exceeds the limit of %d aliases"
+                                         % (loader.maxAliases,), node.start_mark)
+            continue
+        if id(node) in visiting:
+            raise LimitExceededError(None, None, "recursive aliases are not allowed "
+                                     "in limited documents", node.start_mark)
+        visiting.add(id(node))
+        stack.append((node, True))
+        stack.extend((c, False) for c in children)
+
+
 class DuplicateCheckLoader(Loader):
 
     '''
@@ -115,9 +291,27 @@ class DuplicateCheckLoader(Loader):
       key in your Yaml file
     '''
 
+    internKeys = False
+    internTable = None
+    maxBytes = maxNodes = maxDepth = maxAliases = None
+
+    def __init__(self, stream):
+        checkSize(self, stream)
+        Loader.__init__(self, stream)
+
+    def construct_document(self, node):
+        _checkLimits(self, node)
+        return Loader.construct_document(self, node)
+
     def _getMap(self):
         return {}
 
+    def construct_yaml_str(self, node):
+        value = self.construct_scalar(node)
+        if self.internTable is not None:
+            value = self.internTable.intern(value)
+        return value
+
     def construct_yaml_map(self, node):
         data = self._getMap()
         yield data
@@ -137,6 +331,8 @@ class DuplicateCheckLoader(Loader):
             except TypeError as exc:
                 raise ConstructorError("while constructing a mapping", node.start_mark,
                                        "found unacceptable key (%s)" % exc, key_node.start_mark)
+            if self.internKeys and type(key) is str:
+                key = _sys.intern(key)
             value = self.construct_object(value_node, deep=deep)
             if key in mapping:
                 raise ConstructorError("while constructing a mapping", node.start_mark,
@@ -154,9 +350,27 @@ class SafeDuplicateCheckLoader(SafeLoader):
       key in your Yaml file
     '''
 
+    internKeys = False
+    internTable = None
+    maxBytes = maxNodes = maxDepth = maxAliases = None
+
+    def __init__(self, stream):
+        checkSize(self, stream)
+        SafeLoader.__init__(self, stream)
+
+    def construct_document(self, node):
+        _checkLimits(self, node)
+        return SafeLoader.construct_document(self, node)
+
     def _getMap(self):
         return {}
 
+    def construct_yaml_str(self, node):
+        value = self.construct_scalar(node)
+        if self.internTable is not None:
+            value = self.internTable.intern(value)
+        return value
+
     def construct_yaml_map(self, node):
         data = self._getMap()
         yield data
@@ -176,6 +390,8 @@ class SafeDuplicateCheckLoader(SafeLoader):
             except TypeError as exc:
                 raise ConstructorError("while constructing a mapping", node.start_mark,
                                        "found unacceptable key (%s)" % exc, key_node.start_mark)
+            if self.internKeys and type(key) is str:
+                key = _sys.intern(key)
             value = self.construct_object(value_node, deep=deep)
             if key in mapping:
                 raise ConstructorError("while constructing a mapping", node.start_mark,
@@ -218,6 +434,9 @@ OrderedMapAndDuplicateCheckLoader.add_constructor(
 OrderedMapAndDuplicateCheckLoader.add_constructor(
     'tag:yaml.org,2002:python/dict',
     OrderedMapAndDuplicateCheckLoader.construct_yaml_map)
+OrderedMapAndDuplicateCheckLoader.add_constructor(
+    'tag:yaml.org,2002:str',
+    OrderedMapAndDuplicateCheckLoader.construct_yaml_str)
 
 # Overwrite the map creation constructors (safe loaders)
 SafeOrderedMapAndDuplicateCheckLoader.add_constructor(
@@ -226,6 +445,9 @@ SafeOrderedMapAndDuplicateCheckLoader.add_constructor(
 SafeOrderedMapAndDuplicateCheckLoader.add_constructor(
     'tag:yaml.org,2002:python/dict',
     SafeOrderedMapAndDuplicateCheckLoader.construct_yaml_map)
+SafeOrderedMapAndDuplicateCheckLoader.add_constructor(
+    'tag:yaml.org,2002:str',
+    SafeOrderedMapAndDuplicateCheckLoader.construct_yaml_str)
 
 # Overwrite the map creation constructors
 DuplicateCheckLoader.add_constructor(
@@ -234,6 +456,9 @@ DuplicateCheckLoader.add_constructor(
 DuplicateCheckLoader.add_constructor(
     'tag:yaml.org,2002:python/dict',
     DuplicateCheckLoader.construct_yaml_map)
+DuplicateCheckLoader.add_constructor(
+    'tag:yaml.org,2002:str',
+    DuplicateCheckLoader.construct_yaml_str)
 
 # Overwrite the map creation constructors (safe loaders)
 SafeDuplicateCheckLoader.add_constructor(
@@ -242,6 +467,9 @@ SafeDuplicateCheckLoader.add_constructor(
 SafeDuplicateCheckLoader.add_constructor(
     'tag:yaml.org,2002:python/dict',
     SafeDuplicateCheckLoader.construct_yaml_map)
+SafeDuplicateCheckLoader.add_constructor(
+    'tag:yaml.org,2002:str',
+    SafeDuplicateCheckLoader.construct_yaml_str)
 
 _orig_load = load
 _orig_safe_load = safe_load
@@ -266,7 +494,59 @@ def _safeLoad(*args, **kwargs):
     '''
     if "Loader" not in kwargs:
         kwargs["Loader"] = SafeDuplicateCheckLoader
-    return _orig_safe_load(*args, **kwargs)
+    # recent PyYAML versions do not accept a Loader in safe_load
+    return _orig_load(*args, **kwargs)
 
 load = _load
 safe_load = _safeLoad
+
+
+def _representOrderedMapping(dumper, data):
+    # items are given as a list, so that they are not sorted
+    return dumper.represent_mapping('tag:yaml.org,2002:map', list(data.items()))
+
+
+def _representTuple(dumper, data):
+    return dumper.represent_list(data)
+
+
+class OrderedDumper(_Dumper):
+
+    '''
+    I am a Dumper (using libyaml if available) which dumps the OrderedDict and the Namespaces as
+      plain mappings, in their order, and the tuples as sequences
+    '''
+
+
+class SafeOrderedDumper(_SafeDumper):
+
+    '''
+    I am the safe version of the OrderedDumper
+    '''
+
+
+for _dumper in (OrderedDumper, SafeOrderedDumper):
+    # the unsafe representer has its own representer for exactly OrderedDict
+    _dumper.add_representer(OrderedDict, _representOrderedMapping)
+    _dumper.add_multi_representer(OrderedDict, _representOrderedMapping)
+    _dumper.add_multi_representer(_Namespace, _representOrderedMapping)
+    _dumper.add_representer(tuple, _representTuple)
+
+
+def dumpStream(data, stream, Dumper=OrderedDumper, **kwds):
+    '''
+    Dump data to stream like yaml.dump, item by item for the mappings and sequences, so that
+      only the nodes of one item are in memory at once. The aliases between items are not kept.
+    '''
+    kwds["default_flow_style"] = False
+    if isinstance(data, dict) and data:
+        items = data.items()
+        if kwds.get("sort_keys", True) and type(data) is dict:
+            items = sorted(items)
+        for k, v in items:
+            dump(OrderedDict([(k, v)]), stream, Dumper=Dumper, **kwds)
+    elif isinstance(data, (list, tuple)) and data:
+        for v in data:
+            dump([v], stream, Dumper=Dumper, **kwds)
+    else:
+        dump(data, stream, Dumper=Dumper, **kwds)
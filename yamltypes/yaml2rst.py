@@ -3,10 +3,16 @@
 
 import argparse
 import glob
+import hashlib
+import json
 import os
-import pprint
 
-from . import yaml
+# PyYAML is imported once the arguments are parsed, so that --help stays fast
+
+# hashes of the inputs of each generated file, stored in the output directory
+MANIFEST = ".yaml2rst.manifest.json"
+# to be increased when the generated rst changes, to invalidate the manifests
+RENDER_VERSION = 1
 
 
 BASE_TYPES = {
@@ -56,7 +62,6 @@ BASE_TYPES = {
                               "                type: integer\n"
                               ), type="base")
 }
-known_types = set()
 
 
 class RstFile(object):
@@ -64,13 +69,18 @@ class RstFile(object):
     """
     This File like object implements helper for generating a rst file from a yaml meta spec
 
-    It does not derivate from file to avoid unexpected side effects
+    It does not derivate from file to avoid unexpected side effects.
+    The content is kept in memory, and written to filename when closed.
     """
 
-    def __init__(self, filename, namespace):
-        self.out = open(filename, "w")
+    def __init__(self, filename, namespace, known_types=None):
+        if known_types is None:
+            known_types = set(BASE_TYPES)
+        self.filename = filename
+        self.out = []
         self.numindent = 0
         self.namespace = namespace
+        self.known_types = known_types
 
     def write(self, s="", forceIndent=None):
         if forceIndent is not None:
@@ -79,10 +89,24 @@ class RstFile(object):
             numindent = self.numindent
         if s.endswith("\n"):
             s = s[:-1]
-        return self.out.write(" " * numindent + s.replace("\n", "\n" + " " * numindent) + "\n")
+        if numindent:
+            s = s.replace("\n", "\n" + " " * numindent)
+        self.out.append(" " * numindent + s + "\n")
+
+    def getvalue(self):
+        return "".join(self.out)
 
     def close(self):
-        self.out.close()
+        if self.filename is None:
+            return
+        content = self.getvalue()
+        # keep the file, and its mtime, if it did not change
+        if os.path.exists(self.filename):
+            with open(self.filename) as f:
+                if f.read() == content:
+                    return
+        with open(self.filename, "w") as f:
+            f.write(content)
 
     def indent(self):
         self.numindent += 4
@@ -104,7 +128,7 @@ class RstFile(object):
         basetype = typ[len(collection):]
         if basetype.endswith("s"):
             basetype = basetype[:-1]
-        if basetype in known_types:
+        if basetype in self.known_types:
             basetype = ":ref:`%s_%s`" % (self.namespace, basetype)  # adds an internal link
         return basetype
 
@@ -130,7 +154,7 @@ class RstFile(object):
         known_type = False
         if typ == "base":
             known_type = True
-        if typ in known_types:
+        if typ in self.known_types:
             known_type = True
             self.makeType(":ref:`%s_%s`" % (self.namespace, typ))
         for collection in ("setof", "listof", "mapof"):
@@ -181,6 +205,7 @@ class RstFile(object):
             self.write()
             self.write()
         if not known_type:
+            import pprint
             pprint.pprint(v)
         if "values" in v:
             self.write("**Allowed values:**")
@@ -189,19 +214,94 @@ class RstFile(object):
             self.write()
 
 
+def typeFiles(paths):
+    ret = []
+    for p in paths:
+        ret.extend(glob.glob(os.path.join(p, "*.type.yaml")))
+    return ret
+
+
+def metaFiles(d):
+    return [fn for fn in sorted(glob.glob(os.path.join(d, "*.meta.yaml")))
+            if "types.meta" not in fn]
+
+
 def loadTypes(paths):
+    from . import yaml
     ret = {}
-    for p in paths:
-        for fn in glob.glob(os.path.join(p, "*.type.yaml")):
-            with open(fn) as y:
-                ret[fn.replace(".type.yaml", "")] = yaml.safe_load(y)
+    for fn in typeFiles(paths):
+        with open(fn) as y:
+            ret[fn.replace(".type.yaml", "")] = yaml.safe_load(y)
     return ret
 
 
+def hashInputs(fns, *extra):
+    """hash of the given files (names and contents), and of the extra values"""
+    h = hashlib.sha256(repr(extra).encode("utf-8"))
+    for fn in fns:
+        with open(fn, "rb") as f:
+            content = f.read()
+        h.update(("\0%s\0%d\0" % (fn, len(content))).encode("utf-8"))
+        h.update(content)
+    return h.hexdigest()
+
+
+def loadManifest(fn):
+    try:
+        with open(fn) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def saveManifest(fn, manifest):
+    tmpfn = fn + ".tmp"
+    with open(tmpfn, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmpfn, fn)
+
+
 def columnSeparatedPath(s):
     return s.split(":")
 
 
+def renderDirectory(d, outfn, types, dumpTypes=True):
+    """write in outfn the documentation of the .meta.yaml files of the directory d
+
+    types is the sorted list of (name, spec) of the base and loaded types, which are
+    documented if dumpTypes is True.
+    """
+    from . import yaml
+    basedir = os.path.basename(d)
+    out = RstFile(outfn, basedir)
+    out.makeTitle("YAML documentation for the product '%s'" % (basedir,), "=")
+    out.makeTitle("Base types", "~")
+    out.write("These are the base types that can be used in the Yaml files.")
+    out.write()
+
+    if dumpTypes:
+        for k, v in types:
+            out.write(".. _%s_%s:" % (basedir, k))
+            out.write()
+            out.write()
+            out.makeTitle("``%s``" % (k,), '_')
+            out.dumpTypeSpec(basedir + "_" + k, v, basedir + "." + k)
+    for fn in metaFiles(d):
+        with open(fn) as f:
+            v = yaml.load(f)
+        k = os.path.basename(fn).replace(".meta", "")
+        out.write(".. _%s_file_type_%s:" % (basedir, k))
+        out.write()
+        out.write()
+        out.makeTitle("``%s``" % (k,), '~')
+        if 'root' in v:
+            if 'description' not in v['root']:
+                print("warning", fn, "does not have a description")
+            out.dumpTypeSpec(basedir + "_" + k, v['root'], basedir + "." + k)
+
+    out.close()
+
+
 def main():
     def dir_arg(path):
         if os.path.isdir(path):
@@ -214,42 +314,43 @@ def main():
                         help='paths where to find meta.yaml files', default=[])
     parser.add_argument('--output', type=dir_arg,
                         help='output directory', required=True)
+    parser.add_argument('--jobs', '-j', type=int, default=None,
+                        help='number of directories rendered in parallel '
+                        '(default: number of CPUs)')
+    parser.add_argument('--force', action='store_true',
+                        help='render all the directories, even if their inputs did not change')
     args = parser.parse_args()
-    dumped_types = set()
-    for d in args.directories:
-        basedir = os.path.basename(d)
-        outfn = os.path.join(args.output,
-                             basedir + ".rst")
-        out = RstFile(outfn, basedir)
-        out.makeTitle("YAML documentation for the product '%s'" % (basedir,), "=")
-        out.makeTitle("Base types", "~")
-        out.write("These are the base types that can be used in the Yaml files.")
-        out.write()
 
-        known_types.update(list(BASE_TYPES.keys()))
-        types = list(BASE_TYPES.items()) + list(loadTypes(args.path).items())
-        types.sort()
+    manifestfn = os.path.join(args.output, MANIFEST)
+    manifest = {} if args.force else loadManifest(manifestfn)
+    updated = {}
+    typesHash = hashInputs(typeFiles(args.path))
+    jobs = []
+    for i, d in enumerate(args.directories):
+        outfn = os.path.join(args.output, os.path.basename(d) + ".rst")
+        # the types are only documented in the first directory
+        dumpTypes = i == 0
+        inputsHash = hashInputs(metaFiles(d), RENDER_VERSION, dumpTypes, dumpTypes and typesHash)
+        if manifest.get(os.path.basename(outfn)) == inputsHash and os.path.exists(outfn):
+            continue
+        updated[os.path.basename(outfn)] = inputsHash
+        jobs.append((d, outfn, dumpTypes))
+    if not jobs:
+        return
 
-        for k, v in types:
-            if k not in dumped_types:
-                dumped_types.add(k)
-                out.write(".. _%s_%s:" % (basedir, k))
-                out.write()
-                out.write()
-                out.makeTitle("``%s``" % (k,), '_')
-                out.dumpTypeSpec(basedir + "_" + k, v, basedir + "." + k)
-        for fn in sorted(glob.glob(os.path.join(d, "*.meta.yaml"))):
-            if "types.meta" in fn:
-                continue
-            v = yaml.load(open(fn))
-            k = os.path.basename(fn).replace(".meta", "")
-            out.write(".. _%s_file_type_%s:" % (basedir, k))
-            out.write()
-            out.write()
-            out.makeTitle("``%s``" % (k,), '~')
-            if 'root' in v:
-                if 'description' not in v['root']:
-                    print("warning", fn, "does not have a description")
-                out.dumpTypeSpec(basedir + "_" + k, v['root'], basedir + "." + k)
+    # the type libraries are the same for all the directories
+    types = list(BASE_TYPES.items()) + list(loadTypes(args.path).items())
+    types.sort()
 
-        out.close()
+    jobs = [(d, outfn, types, dumpTypes) for d, outfn, dumpTypes in jobs]
+    if args.jobs == 1 or len(jobs) == 1:
+        for job in jobs:
+            renderDirectory(*job)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(args.jobs) as pool:
+            for f in [pool.submit(renderDirectory, *job) for job in jobs]:
+                # raise the errors of the workers
+                f.result()
+    manifest.update(updated)
+    saveManifest(manifestfn, manifest)
@@ -1,92 +1,568 @@
 from __future__ import absolute_import
 import copy
-import logging
+import itertools
 import os
+import weakref
 
 from dictns import Namespace
 
-from . import yaml
+# PyYAML (through .yaml) and logging are imported lazily, when a document is
+# parsed or dumped, or when customizations are applied: they are the bulk of the
+# import time of this module, which matters for short lived command line tools.
 
-cactusLog = logging.getLogger(__name__)
+
+def _getLog():
+    import logging
+    return logging.getLogger(__name__)
+
+
+def __getattr__(name):
+    # backward compatibility for the former module level logger
+    if name == "cactusLog":
+        return _getLog()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def _truncateValue(value, depth, maxDepth, maxItems, budget):
+    """copy of value truncated to maxDepth levels and maxItems items per container
+
+    budget is a one item list holding the estimated number of characters the dump can
+    still use, shared by the whole value: once it is spent, the remaining items are
+    replaced by a marker, so that the size of the copy is bounded whatever the width
+    and depth of value.
+    """
+    if isinstance(value, (dict, list, tuple)) and value and (depth == maxDepth or budget[0] <= 0):
+        return "..."
+    indent = 4 * depth + 2
+    if isinstance(value, dict):
+        ret = {}
+        for k, v in itertools.islice(value.items(), maxItems):
+            if budget[0] <= 0:
+                break
+            budget[0] -= indent + len(_truncateScalar(k))
+            ret[k] = _truncateValue(v, depth + 1, maxDepth, maxItems, budget)
+        if len(ret) < len(value):
+            ret["..."] = "%d more items" % (len(value) - len(ret))
+        return ret
+    if isinstance(value, (list, tuple)):
+        ret = []
+        for v in itertools.islice(value, maxItems):
+            if budget[0] <= 0:
+                break
+            budget[0] -= indent
+            ret.append(_truncateValue(v, depth + 1, maxDepth, maxItems, budget))
+        if len(ret) < len(value):
+            ret.append("... %d more items" % (len(value) - len(ret)))
+        return ret
+    if isinstance(value, str) and len(value) > budget[0]:
+        # still longer than the budget, so that the dump is marked as truncated
+        value = value[:max(budget[0], 0) + 1]
+    budget[0] -= len(_truncateScalar(value))
+    return value
+
+
+def _truncateScalar(value):
+    """the estimated rendering of a scalar, only used for its size"""
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (dict, list, tuple)):
+        # containers are accounted for item by item
+        return ""
+    return repr(value)
 
 
 class YamlError(ValueError):
 
     """exception sent in case of any error in the yaml files
     Used to output coherent and understandable error messages
+
+    The offending value is only kept by reference, and dumped when the error is displayed,
+    truncated to maxDepth levels, maxItems items per container and maxBytes characters
+    (None for no limit), which also bound the part of the value which is dumped. The
+    message can be a callable, if it is costly to build.
     """
 
+    maxDepth = 6
+    maxItems = 50
+    maxBytes = 20000
+
     def __init__(self, path, value, message):
-        ValueError.__init__(self, "%s: %s\ncode:\n%s\n"
-                            % (path, message, yaml.dump(value, indent=4)))
+        ValueError.__init__(self, path, value, message)
+        self.path = path
+        self.value = value
+        self._message = message
+        self._str = None
+
+    @property
+    def message(self):
+        if callable(self._message):
+            self._message = self._message()
+        return self._message
+
+    def dumpValue(self):
+        from . import yaml
+        budget = [float("inf") if self.maxBytes is None else self.maxBytes]
+        value = _truncateValue(self.value, 0, self.maxDepth, self.maxItems, budget)
+        try:
+            ret = yaml.dump(value, indent=4)
+        except Exception:
+            # e.g. keys which cannot be sorted
+            ret = repr(value) + "\n"
+        if self.maxBytes is not None and len(ret) > self.maxBytes:
+            ret = ret[:self.maxBytes] + "\n... truncated\n"
+        return ret
+
+    def __str__(self):
+        if self._str is None:
+            self._str = "%s: %s\ncode:\n%s\n" % (self.path, self.message, self.dumpValue())
+        return self._str
+
+    def __repr__(self):
+        return "%s(%r, %r)" % (self.__class__.__name__, self.path, self.message)
+
+    def __reduce__(self):
+        # do not send the whole value to other processes, only its rendering
+        return (self.__class__, (self.path, None, self.message), dict(_str=str(self)))
 
 
 class CustomizationError(ValueError):
     pass
 
 
+class Condition(object):
+
+    """a python expression used as a modifier (required, forbidden, maybenull)
+    It is compiled once with the spec, and evaluated against each validated document,
+    which is available as 'self' in the expression.
+    """
+
+    __slots__ = ('source', 'code')
+
+    def __init__(self, path, source):
+        self.source = source
+        try:
+            self.code = compile(source, path, "eval")
+        except SyntaxError as e:
+            raise YamlError(path, source,
+                            "issue with python expression in yaml:\n" + str(e))
+
+    def evaluate(self, path, ctx):
+        # the value only depends on the document, so it is computed once per validation
+        try:
+            return ctx.values[self]
+        except KeyError:
+            pass
+        try:
+            value = eval(self.code, dict(), dict(self=ctx.namespace))
+        except Exception as e:
+            raise YamlError(path, self.source,
+                            "issue with python expression in yaml:\n" + str(e))
+        ctx.values[self] = value
+        return value
+
+    def __eq__(self, other):
+        return isinstance(other, Condition) and self.source == other.source
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.source)
+
+    def __repr__(self):
+        return "Condition(%r)" % (self.source,)
+
+
+def evaluateModifier(modifier, path, ctx):
+    if isinstance(modifier, Condition):
+        return modifier.evaluate(path, ctx)
+    return modifier
+
+
+class ValidationRecord(object):
+
+    """what the revalidations of a document need to know about its previous validations
+    (see YamlSpec.revalidate)"""
+
+    __slots__ = ('filled', 'conditions')
+
+    def __init__(self):
+        # the keys filled with defaults, by id of their dict: {id: (dict, keys)}, the dict
+        # being kept so that its id is not reused
+        self.filled = {}
+        # the values of the conditions which were evaluated
+        self.conditions = {}
+
+
+def _recordFilled(filled, val, k):
+    entry = filled.get(id(val))
+    if entry is None:
+        entry = filled[id(val)] = (val, set())
+    entry[1].add(k)
+
+
+def _filledKeys(filled, val):
+    entry = filled.get(id(val))
+    return () if entry is None else entry[1]
+
+
+class MatchContext(object):
+
+    """state of the validation of one document"""
+
+    __slots__ = ('root', '_namespace', 'rootType', 'sample', 'conditions', 'filled', 'values')
+
+    def __init__(self, root, rootType=None, sample=None, conditions=True, lazy=False,
+                 record=None):
+        self.root = root
+        self._namespace = None
+        # if set, the defaults are not filled, but served by a DefaultsNamespace
+        self.rootType = rootType
+        # if set, only this number of the elements of the bigger collections are matched
+        self.sample = sample
+        # whether the spec has conditions (see usesConditions): they are evaluated
+        # against the document as it was before any default is filled
+        self.conditions = conditions
+        # in lazy mode, or if a ValidationRecord is given, the keys filled with defaults
+        # are recorded: the conditions see the document through an InputNamespace,
+        # instead of a copy
+        if record is None and lazy:
+            record = ValidationRecord()
+        self.filled = None if record is None else record.filled
+        # the values of the conditions, see Condition.evaluate
+        self.values = {}
+
+    @property
+    def namespace(self):
+        # only built if a condition needs it
+        if self._namespace is None:
+            self.snapshot()
+        return self._namespace
+
+    def snapshot(self):
+        """build the namespace of the conditions, before the document is modified"""
+        # with lazyDefaults, the defaults are never filled in the document
+        if self.filled is not None:
+            self._namespace = InputNamespace(self.root, self)
+        else:
+            self._namespace = toNamespace(self.root)
+
+
 class Type(object):
 
     """basic types (str, int, etc)"""
 
-    def __init__(self, name, _type, values=None):
+    __slots__ = ('name', 'type', 'values', 'required', 'default', 'forbidden', 'maybenull',
+                 '_valueset', '_conditions', '__weakref__')
+    modifiers = ('required', 'default', 'forbidden', 'maybenull')
+
+    def __init__(self, name, _type, values=None, required=None, default=None,
+                 forbidden=None, maybenull=None):
         if values is None:
             values = []
         self.name = name
         self.type = _type
         self.values = values
+        self.required = required
+        self.default = default
+        self.forbidden = forbidden
+        self.maybenull = maybenull
+        self._valueset = None
+        # the conditional modifiers of its kids the validity of this type depends on
+        self._conditions = frozenset()
+
+    def optimize(self):
+        """precompute what is needed for fast matching.
+        Called once the whole spec is compiled, it can be called several times.
+        """
+        # the kids first, without recursion, as specs can be arbitrarily deep
+        for t in _postOrder(self):
+            t.optimize_level()
+
+    def optimize_level(self):
+        """precompute what is needed at this level, once the kids are optimized"""
+        if self.values and self._valueset is None:
+            try:
+                self._valueset = frozenset(self.values)
+            except TypeError:
+                pass
+
+    def withModifiers(self, **modifiers):
+        """return a copy of this type with the given modifiers.
+        Modifiers which are not given are reset to None.
+        """
+        ret = copy.copy(self)
+        for k in self.modifiers:
+            setattr(ret, k, modifiers.get(k))
+        return ret
 
-    def ensure_type(self, path, val):
-        if self.maybenull and val is None:
-            return
+    def ensure_type(self, path, val, ctx=None):
+        if val is None and self.maybenull:
+            if ctx is None:
+                ctx = MatchContext(val)
+            if evaluateModifier(self.maybenull, path, ctx):
+                return
         if self.type == "anything":
             return
-        if str(val).lower() == "none":
+        # the str of a dict or list is never "none", and costs as much as their content
+        if not isinstance(val, (dict, list)) and str(val).lower() == "none":
             return
         if not isinstance(val, self.type):
             raise YamlError(path, val, "should be of type '%s', while it is '%s'." %
                             (str(self.type), type(val)))
 
     def ensure_values(self, path, val):
-        if self.values and val not in self.values:
-            raise YamlError(path, val, "'%s' should be one of: %s" % (val,
-                                                                      ", ".join(self.values)))
+        if not self.values:
+            return
+        try:
+            found = val in self._valueset
+        except TypeError:
+            # not optimized, or unhashable value
+            found = val in self.values
+        if not found:
+            raise YamlError(path, val, lambda: "'%s' should be one of: %s" % (val,
+                                                                              ", ".join(self.values)))
+
+    def match(self, name, val, ctx=None):
+        if ctx is None:
+            ctx = MatchContext(val)
+        self.ensure_type(name, val, ctx)
+        self.ensure_values(name, val)
 
-    def match(self, name, val):
-        self.ensure_type(name, val)
+    def match_steps(self, name, val, ctx):
+        """match what val is at its level, and return None, or an iterator of the
+        (spec, path, value) of its kids to match (see runSteps)
+        """
+        self.ensure_type(name, val, ctx)
         self.ensure_values(name, val)
 
+    def match_all(self, vals):
+        """check all the elements of a collection at once, without reporting errors.
+        Returns False if one of them may not match, they then need to be matched one by one.
+        """
+        if self.type != "anything":
+            for t in set(map(type, vals)):
+                if not issubclass(t, self.type):
+                    return False
+        if not self.values:
+            return True
+        if self._valueset is None:
+            return False
+        try:
+            return self._valueset.issuperset(vals)
+        except TypeError:
+            return False
+
+    def kid_types(self):
+        """the types of the kids of this type"""
+        return ()
+
+    def is_optimized(self):
+        """whether this type and its kids are optimized already"""
+        return False
+
+    def kids(self, val):
+        """the (key, type) of the kids of val, if val is of this type"""
+        return ()
+
+    def to_arrays(self, val, makeArray):
+        """return val, with its validated lists of numbers converted by makeArray"""
+        ret = [val]
+        todo = [(self, ret, 0)]
+        while todo:
+            t, parent, k = todo.pop()
+            v = parent[k]
+            if isinstance(t, List) and isinstance(v, list) and (
+                    t.spec.type in _arrayTypes and not isinstance(t.spec, Container)):
+                try:
+                    parent[k] = makeArray(t.spec.type, v)
+                except (TypeError, ValueError, OverflowError):
+                    # null elements, or integers too big for the array
+                    pass
+                continue
+            todo.extend((kt, v, kk) for kk, kt in t.kids(v) if isinstance(kt, Container))
+        return ret[0]
+
+    def match_level(self, path, val, ctx):
+        """check what val contains at its level, when one of its values changed"""
+
+    def match_conditions(self, path, val, ctx, conditions=None):
+        """check the conditional modifiers of the kids of val, recursively
+        If conditions is given, only the types depending on one of them are walked.
+        """
+        todo = [(self, path, val)]
+        while todo:
+            t, path, val = todo.pop()
+            if not t._conditions or (conditions is not None and
+                                     t._conditions.isdisjoint(conditions)):
+                continue
+            if isinstance(val, dict):
+                t.check_conditionals(path, val, ctx)
+                kids = [(kt, path + "." + k, val[k]) for k, kt in t.kids(val)]
+            else:
+                kids = [(kt, "%s[%d]" % (path, k), val[k]) for k, kt in t.kids(val)]
+            # in reverse, so that they are checked in order
+            todo.extend(reversed(kids))
+
+    def check_conditionals(self, path, val, ctx):
+        """check the conditional modifiers of the keys of the dict val"""
+
+
+def _postOrder(t):
+    """the types of the spec t, each one after its kids"""
+    order = []
+    seen = set()
+    todo = [(t, False)]
+    while todo:
+        t, expanded = todo.pop()
+        if expanded:
+            order.append(t)
+            continue
+        if id(t) in seen or t.is_optimized():
+            continue
+        seen.add(id(t))
+        todo.append((t, True))
+        todo.extend((kt, False) for kt in t.kid_types())
+    return order
+
+
+# leaf types are immutable once compiled, so identical ones are shared
+# between all the specs of the process
+_leafTypes = weakref.WeakValueDictionary()
+
+
+def usesConditions(t):
+    """whether the spec t has conditional modifiers"""
+    seen = set()
+    todo = [t]
+    while todo:
+        t = todo.pop()
+        if id(t) in seen:
+            continue
+        seen.add(id(t))
+        if any(isinstance(getattr(t, m), Condition) for m in ('required', 'forbidden',
+                                                               'maybenull')):
+            return True
+        todo.extend(t.kid_types())
+    return False
+
+
+def internType(t):
+    """return the shared instance of the leaf type equivalent to t
+    Containers, and leaf types with unhashable modifiers are returned as is.
+    """
+    if type(t) is not Type:
+        return t
+
+    def key(v):
+        # 1 == True == 1.0, but they are not interchangeable defaults
+        return (type(v), v)
+    try:
+        k = (t.name, t.type, tuple(key(v) for v in t.values)) + tuple(
+            key(getattr(t, m)) for m in Type.modifiers)
+        return _leafTypes.setdefault(k, t)
+    except TypeError:
+        return t
+
 
 class Container(Type):
 
     """container types dict,list, listofstrings, listofsetstringss, etc
     """
 
-    def __init__(self, name, type, spec):
-        self.name = name
-        self.type = type
+    __slots__ = ('spec',)
+
+    def __init__(self, name, type, spec, **modifiers):
+        Type.__init__(self, name, type, **modifiers)
         self.spec = spec
 
-    def match(self, name, val):
-        self.ensure_type(name, val)
-        self.iter_and_match(name, val)
+    def optimize_level(self):
+        Type.optimize_level(self)
+        self._conditions = self.spec._conditions
+
+    def kid_types(self):
+        return (self.spec,)
+
+    def match(self, name, val, ctx=None):
+        if ctx is None:
+            ctx = MatchContext(val, conditions=usesConditions(self))
+        runSteps(self.match_steps(name, val, ctx), ctx)
+
+    def match_steps(self, name, val, ctx):
+        self.ensure_type(name, val, ctx)
+        return self.iter_steps(name, val, ctx)
 
-    def match_spec(self, spec, name, val):
+    def iter_and_match(self, path, val, ctx):
+        runSteps(self.iter_steps(path, val, ctx), ctx)
+
+    def match_all(self, vals):
+        return False
+
+    def match_spec(self, spec, name, val, ctx):
         try:
-            spec.match(name, val)
+            spec.match(name, val, ctx)
         except AttributeError as e:
-            msg = "Error in {}\n. Message: {}".format(name, e.message)
+            msg = "Error in {}\n. Message: {}".format(name, e)
             raise AttributeError(msg)
 
 
+def sampleIndexes(path, size, sample):
+    """the sorted indexes of the elements of the collection at path to match, in sample mode
+    They only depend on the path and the size, so that the runs are reproducible.
+    """
+    import random
+    import zlib
+    rnd = random.Random(zlib.crc32(path.encode("utf-8")) ^ size)
+    return sorted(rnd.sample(range(size), sample))
+
+
+def runSteps(steps, ctx):
+    """match the kids yielded by steps, and their own kids, depth first
+
+    The containers being matched are kept on an explicit stack of iterators
+    rather than on the python stack, so documents can be arbitrarily deep.
+    """
+    if steps is None:
+        return
+    stack = [steps]
+    push = stack.append
+    pop = stack.pop
+    while stack:
+        for spec, path, val in stack[-1]:
+            try:
+                steps = spec.match_steps(path, val, ctx)
+            except AttributeError as e:
+                raise AttributeError("Error in {}\n. Message: {}".format(path, e))
+            if steps is not None:
+                push(steps)
+                break
+        else:
+            pop()
+
+
 class List(Container):
 
     """ Spec is a Type that is matched against all elements"""
 
-    def iter_and_match(self, path, val):
-        for i in range(len(val)):
-            self.match_spec(self.spec, "%s[%d]" % (path, i),
-                            val[i])
+    __slots__ = ()
+
+    def iter_steps(self, path, val, ctx):
+        # collections of scalars are checked in bulk, and matched one by one
+        # only to find the offending element
+        if self.spec.match_all(val):
+            return
+        spec = self.spec
+        if ctx.sample is not None and isinstance(spec, Container) and len(val) > ctx.sample:
+            for i in sampleIndexes(path, len(val), ctx.sample):
+                yield spec, "%s[%d]" % (path, i), val[i]
+            return
+        for i, v in enumerate(val):
+            yield spec, "%s[%d]" % (path, i), v
+
+    def kids(self, val):
+        if not isinstance(val, list):
+            return ()
+        return zip(range(len(val)), itertools.repeat(self.spec))
 
 
 class Set(List):
@@ -95,8 +571,17 @@ class Set(List):
         each element can appear only once
     """
 
-    def match(self, path, val):
-        Container.match(self, path, val)
+    __slots__ = ()
+
+    def iter_steps(self, path, val, ctx):
+        yield from List.iter_steps(self, path, val, ctx)
+        # once all the elements are matched
+        self.check_unique(path, val)
+
+    def match_level(self, path, val, ctx):
+        self.check_unique(path, val)
+
+    def check_unique(self, path, val):
         if len(val) != len(set(val)):
             _val = copy.deepcopy(val)
             while len(_val):
@@ -110,21 +595,116 @@ class Dict(Container):
 
     """ spec is a dictionary of Types"""
 
-    def iter_and_match(self, path, val):
-        for k, s in list(self.spec.items()):
-            if s.required and k not in val:
+    __slots__ = ('_keys', '_required', '_forbidden', '_conditionals', '_defaults')
+
+    def __init__(self, name, type, spec, **modifiers):
+        Container.__init__(self, name, type, spec, **modifiers)
+        self._keys = None
+
+    def optimize_level(self):
+        if self._keys is not None:
+            return
+        Type.optimize_level(self)
+        self._required = frozenset(k for k, s in self.spec.items()
+                                   if s.required and not isinstance(s.required, Condition))
+        self._forbidden = frozenset(k for k, s in self.spec.items()
+                                    if s.forbidden and not isinstance(s.forbidden, Condition))
+        self._conditionals = tuple((k, s) for k, s in self.spec.items()
+                                   if isinstance(s.required, Condition) or
+                                   isinstance(s.forbidden, Condition))
+        self._conditions = frozenset(
+            m for _, s in self._conditionals for m in (s.required, s.forbidden)
+            if isinstance(m, Condition)).union(*(s._conditions for s in self.spec.values()))
+        self._defaults = tuple((k, s.default) for k, s in self.spec.items()
+                               if s.default is not None)
+        self._keys = frozenset(self.spec)
+
+    def check_keys(self, path, val, ctx):
+        """raise the error about the first required or forbidden key of the spec
+        which is missing or present in val"""
+        for k, s in self.spec.items():
+            # conditions are only evaluated when they can make a difference
+            if s.required and k not in val and evaluateModifier(s.required, path + "." + k, ctx):
                 raise YamlError(path, val,
-                                "needs to define the option '%s', but only has: %r" % (k, list(val.keys())))
-            if s.forbidden and k in val:
+                                lambda: "needs to define the option '%s', but only has: %r"
+                                % (k, list(val.keys())))
+            if s.forbidden and k in val and evaluateModifier(s.forbidden, path + "." + k, ctx):
                 raise YamlError(path, val,
                                 "option %s is forbidden" % (k,))
-            if s.default is not None and k not in val:
-                val[k] = s.default
+
+    def check_unknown_keys(self, path, val, ctx, match_values=True):
+        """match the values of val, raising on the first key which is not in the spec"""
+        runSteps(self.unknown_keys_steps(path, val, match_values), ctx)
+
+    def unknown_keys_steps(self, path, val, match_values=True):
         for k, v in list(val.items()):
             if k not in self.spec:
                 raise YamlError(path, val,
-                                "Key '%s' not defined in spec file, should be one of: %r" % (k, list(self.spec.keys())))
-            self.match_spec(self.spec[k], path + "." + k, v)
+                                lambda: "Key '%s' not defined in spec file, should be one of: %r"
+                                % (k, list(self.spec.keys())))
+            if match_values:
+                yield self.spec[k], path + "." + k, v
+
+    def spec_of(self, k):
+        return self.spec[k]
+
+    def match_keys(self, path, val, ctx):
+        """check the keys of val and fill its defaults, without matching its values"""
+        self._match_keys(path, val, ctx)
+        if not self._keys.issuperset(val):
+            self.check_unknown_keys(path, val, ctx, match_values=False)
+
+    match_level = match_keys
+
+    def kid_types(self):
+        return tuple(self.spec.values())
+
+    def is_optimized(self):
+        return self._keys is not None
+
+    def kids(self, val):
+        if not isinstance(val, dict):
+            return ()
+        spec = self.spec
+        return ((k, spec[k]) for k in val if k in spec)
+
+    def check_conditionals(self, path, val, ctx):
+        for k, s in self._conditionals:
+            if k in val:
+                failed = s.forbidden and evaluateModifier(s.forbidden, path + "." + k, ctx)
+            else:
+                failed = s.required and evaluateModifier(s.required, path + "." + k, ctx)
+            if failed:
+                self.check_keys(path, val, ctx)
+
+    def _match_keys(self, path, val, ctx):
+        if self._keys is None:
+            self.optimize()
+        # fast path using set operations, the slow path is only used
+        # to report the same error as if keys were checked one by one
+        if self._required.difference(val) or (self._forbidden and
+                                              not self._forbidden.isdisjoint(val)):
+            self.check_keys(path, val, ctx)
+        self.check_conditionals(path, val, ctx)
+        if ctx.rootType is not None:
+            return
+        for k, default in self._defaults:
+            if k not in val:
+                if ctx.conditions:
+                    if ctx.filled is not None:
+                        _recordFilled(ctx.filled, val, k)
+                    elif ctx._namespace is None:
+                        ctx.snapshot()
+                val[k] = default
+
+    def iter_steps(self, path, val, ctx):
+        self._match_keys(path, val, ctx)
+        if not self._keys.issuperset(val):
+            # raises when reaching the first unknown key
+            yield from self.unknown_keys_steps(path, val)
+        spec = self.spec
+        for k, v in val.items():
+            yield spec[k], path + "." + k, v
 
 
 class Map(Container):
@@ -133,50 +713,569 @@ class Map(Container):
     names_type is an optionnal argument to verify the type of the
     names of the list."""
 
-    def __init__(self, name, type, spec, names_type=None):
-        self.names_type = names_type
-        Container.__init__(self, name, type, spec)
+    __slots__ = ('names_type', '_names')
 
-    def iter_and_match(self, path, val):
-        if self.names_type is not None:
-            n = self.name + "_names"
-            keyst = Set(n, list, self.names_type)
-            keyst.maybenull = False
-            keyst.match(n, list(val.keys()))
+    def __init__(self, name, type, spec, names_type=None, **modifiers):
+        self.names_type = names_type
+        self._names = None
+        Container.__init__(self, name, type, spec, **modifiers)
+
+    def optimize_level(self):
+        Container.optimize_level(self)
+        if self.names_type is not None and self._names is None:
+            # keys of a dict are unique, so they just need to be matched as a list
+            self._names = List(self.name + "_names", list, self.names_type, maybenull=False)
+            self._names.optimize()
+
+    def spec_of(self, k):
+        return self.spec
+
+    def kid_types(self):
+        if self.names_type is None:
+            return (self.spec,)
+        return (self.spec, self.names_type)
+
+    def kids(self, val):
+        if not isinstance(val, dict):
+            return ()
+        return zip(val, itertools.repeat(self.spec))
+
+    def match_keys(self, path, val, ctx):
+        """check the keys of val, without matching its values"""
         if val is None:
             raise YamlError(path, val, "Invalid empty value !")
-        for k, v in list(val.items()):
-            self.match_spec(self.spec, path + "." + k, v)
+        if self.names_type is not None:
+            if self._names is None:
+                self.optimize()
+            self._names.iter_and_match(self._names.name, val, ctx)
+
+    match_level = match_keys
+
+    def iter_steps(self, path, val, ctx):
+        self.match_keys(path, val, ctx)
+        if self.spec.match_all(val.values()):
+            return
+        spec = self.spec
+        if ctx.sample is not None and isinstance(spec, Container) and len(val) > ctx.sample:
+            keys = list(val)
+            for i in sampleIndexes(path, len(keys), ctx.sample):
+                yield spec, path + "." + keys[i], val[keys[i]]
+            return
+        for k, v in val.items():
+            yield spec, path + "." + k, v
+
+
+# typecodes of the arrays the validated lists of numbers can be converted to
+_arrayTypes = {int: ("q", "int64"), float: ("d", "float64")}
+
+
+def arrayFactory(arrays=True):
+    """return the function converting a list of numbers of the given type to an array
+
+    arrays is "array" for array.array, "numpy" for numpy arrays, and True for
+    numpy arrays if numpy is available, array.array else.
+    """
+    if arrays in (True, "numpy"):
+        try:
+            import numpy
+        except ImportError:
+            if arrays == "numpy":
+                raise
+        else:
+            return lambda t, val: numpy.array(val, dtype=_arrayTypes[t][1])
+    elif arrays != "array":
+        raise ValueError("arrays should be one of: True, 'array', 'numpy', not %r" % (arrays,))
+    import array
+    return lambda t, val: array.array(_arrayTypes[t][0], val)
+
+
+def lazyMatch(t, path, val, ctx):
+    """match val against t, and return it as a Namespace
+
+    The keys of dicts are checked, but their values are only matched when
+    they are accessed (see LazyNamespace).
+    """
+    if isinstance(t, (Dict, Map)) and isinstance(val, dict):
+        t.ensure_type(path, val, ctx)
+        t.match_keys(path, val, ctx)
+        return LazyNamespace(val, t, path, ctx)
+    t.match(path, val, ctx)
+    return toNamespace(val)
+
+
+class LazyNamespace(Namespace):
+
+    """a Namespace whose values are matched against their spec on first access
+
+    Accessing an invalid value raises its YamlError. validate_all() validates
+    all the values at once, e.g. before serializing.
+    """
+
+    # the internal attributes are private, so that they do not hide the keys of the config
+    __slots__ = ('__type', '__path', '__ctx', '__pending')
+
+    def __new__(cls, val, t, path, ctx):
+        return dict.__new__(cls)
+
+    def __init__(self, val, t, path, ctx):
+        dict.__init__(self, val)
+        # Namespace.__setattr__ sets items
+        object.__setattr__(self, '_LazyNamespace__type', t)
+        object.__setattr__(self, '_LazyNamespace__path', path)
+        object.__setattr__(self, '_LazyNamespace__ctx', ctx)
+        object.__setattr__(self, '_LazyNamespace__pending', set(val))
+
+    def __validated(self, k):
+        v = dict.__getitem__(self, k)
+        if k in self.__pending:
+            v = lazyMatch(self.__type.spec_of(k), self.__path + "." + k, v, self.__ctx)
+            dict.__setitem__(self, k, v)
+            self.__pending.discard(k)
+        return v
+
+    def validate_all(self):
+        """validate all the values, recursively, and return self"""
+        # without recursion, so the document can be arbitrarily deep
+        todo = [self]
+        while todo:
+            todo.extend(v for v in todo.pop().values() if isinstance(v, LazyNamespace))
+        return self
+
+    def __getitem__(self, k):
+        return self.__validated(k)
+
+    def __getattr__(self, name):
+        try:
+            return self.__validated(name)
+        except KeyError as e:
+            raise AttributeError(e)
+
+    def get(self, k, default=None):
+        if k in self:
+            return self.__validated(k)
+        return default
+
+    def values(self):
+        return [self.__validated(k) for k in self]
+
+    def items(self):
+        return [(k, self.__validated(k)) for k in self]
+
+    def pop(self, k, *args):
+        if k in self:
+            self.__validated(k)
+        return dict.pop(self, k, *args)
+
+    def setdefault(self, k, default=None):
+        if k in self:
+            return self.__validated(k)
+        self[k] = default
+        return self[k]
+
+    def __setitem__(self, k, v):
+        self.__pending.discard(k)
+        Namespace.__setitem__(self, k, v)
+
+    __setattr__ = __setitem__
+
+    def update(self, *args, **kw):
+        for k, v in dict(*args, **kw).items():
+            self[k] = v
+
+    def __eq__(self, other):
+        self.validate_all()
+        return dict.__eq__(self, other)
 
+    def __ne__(self, other):
+        return not self == other
 
-def _parseYaml(content):
-    y = yaml.load(content)
+    __hash__ = None
+
+    def __repr__(self):
+        return Namespace.__repr__(self.validate_all())
+
+    def __reduce__(self):
+        return (Namespace, (dict(self.validate_all()),))
+
+    def __deepcopy__(self, memo):
+        return Namespace(copy.deepcopy(dict(self.validate_all())))
+
+    def __copy__(self):
+        return Namespace(dict(self.validate_all()))
+
+    copy = __copy__
+
+
+def _setItem(parent, k, v):
+    # bypasses the conversions of the Namespaces being built
+    if isinstance(parent, dict):
+        dict.__setitem__(parent, k, v)
+    else:
+        parent[k] = v
+
+
+def toNamespace(val):
+    """return Namespace(val), built without recursion, so val can be arbitrarily deep"""
+    if isinstance(val, Namespace) or not isinstance(val, (dict, list)):
+        return Namespace(val)
+    ret = [None]
+    todo = [(ret, 0, val)]
+    while todo:
+        parent, k, v = todo.pop()
+        if isinstance(v, list):
+            new = list(v)
+            items = enumerate(v)
+        else:
+            new = dict.__new__(Namespace)
+            # the items are replaced in place, to keep their order
+            dict.update(new, v)
+            items = v.items()
+        _setItem(parent, k, new)
+        todo.extend((new, i, item) for i, item in items
+                    if isinstance(item, (dict, list)) and not isinstance(item, Namespace))
+    return ret[0]
+
+
+class InputNamespace(Namespace):
+
+    """the document as it was before its defaults were filled, as seen by the conditions
+    in lazy mode
+
+    It is built level by level, when the conditions access it, so that the document
+    is not copied as a whole.
+    """
+
+    __slots__ = ('__ctx',)
+
+    def __new__(cls, val, ctx):
+        return dict.__new__(cls)
+
+    def __init__(self, val, ctx):
+        filled = _filledKeys(ctx.filled, val)
+        dict.__init__(self, ((k, v) for k, v in val.items() if k not in filled))
+        object.__setattr__(self, '_InputNamespace__ctx', ctx)
+
+    def __wrap(self, v):
+        # the dicts of the nested lists are wrapped too, without recursion
+        ret = [v]
+        todo = [(ret, 0, v)]
+        while todo:
+            parent, i, v = todo.pop()
+            if isinstance(v, dict) and not isinstance(v, InputNamespace):
+                parent[i] = InputNamespace(v, self.__ctx)
+            elif isinstance(v, list):
+                parent[i] = new = list(v)
+                todo.extend((new, j, item) for j, item in enumerate(v))
+        return ret[0]
+
+    def __getitem__(self, k):
+        v = dict.__getitem__(self, k)
+        if isinstance(v, (dict, list)) and not isinstance(v, InputNamespace):
+            v = self.__wrap(v)
+            dict.__setitem__(self, k, v)
+        return v
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError as e:
+            raise AttributeError(e)
+
+    def get(self, k, default=None):
+        if k in self:
+            return self[k]
+        return default
+
+    def values(self):
+        return [self[k] for k in self]
+
+    def items(self):
+        return [(k, self[k]) for k in self]
+
+    def __eq__(self, other):
+        return dict(self.items()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+
+def freeze(val):
+    """return a deeply frozen copy of val: FrozenNamespaces for dicts, and tuples for lists"""
+    # the containers are frozen after their items, without recursion
+    frozen = {}
+    seen = set()
+    todo = [(val, False)]
+    while todo:
+        v, expanded = todo.pop()
+        if expanded:
+            if isinstance(v, dict):
+                f = dict.__new__(FrozenNamespace)
+                dict.__init__(f, ((k, frozen.get(id(i), i)) for k, i in v.items()))
+                object.__setattr__(f, '_FrozenNamespace__hash', None)
+            else:
+                f = tuple(frozen.get(id(i), i) for i in v)
+            frozen[id(v)] = f
+            continue
+        if id(v) in seen or isinstance(v, FrozenNamespace):
+            continue
+        if isinstance(v, dict):
+            items = v.values()
+        elif isinstance(v, (list, tuple)):
+            items = v
+        else:
+            continue
+        seen.add(id(v))
+        todo.append((v, True))
+        todo.extend((i, False) for i in items)
+    return frozen.get(id(val), val)
+
+
+class FrozenNamespace(Namespace):
+
+    """a read-only and hashable Namespace, whose values are frozen too (see freeze)
+
+    It can be shared between threads without locking, and copying it returns itself.
+    """
+
+    # the internal attributes are private, so that they do not hide the keys of the config
+    __slots__ = ('__hash',)
+
+    def __new__(cls, val=None):
+        return dict.__new__(cls)
+
+    def __init__(self, val=None):
+        if val is None:
+            val = {}
+        dict.__init__(self, ((k, freeze(v)) for k, v in val.items()))
+        object.__setattr__(self, '_FrozenNamespace__hash', None)
+
+    def __readOnly(self, *args, **kw):
+        raise TypeError("%s is read-only" % (type(self).__name__,))
+
+    __setitem__ = __setattr__ = __delitem__ = __delattr__ = __readOnly
+    clear = pop = popitem = setdefault = update = __readOnly
+
+    def __hash__(self):
+        if self.__hash is None:
+            # the nested FrozenNamespaces are hashed first, without recursion
+            seen = set()
+            todo = [(self, False)]
+            while todo:
+                v, expanded = todo.pop()
+                if expanded:
+                    object.__setattr__(v, '_FrozenNamespace__hash', hash(frozenset(dict.items(v))))
+                    continue
+                if id(v) in seen:
+                    continue
+                seen.add(id(v))
+                if isinstance(v, FrozenNamespace):
+                    if v.__hash is not None:
+                        continue
+                    todo.append((v, True))
+                    v = dict.values(v)
+                todo.extend((i, False) for i in v if isinstance(i, (FrozenNamespace, tuple)))
+        return self.__hash
+
+    def __reduce__(self):
+        return (FrozenNamespace, (dict(self),))
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __copy__(self):
+        return self
+
+    copy = __copy__
+
+
+def _specOf(t, k):
+    """the spec of the key k of a dict of type t, None if it is unknown"""
+    if isinstance(t, Dict):
+        return t.spec.get(k)
+    return t.spec
+
+
+def defaultsView(t, val):
+    """return val as a Namespace whose dicts serve the defaults of t (see DefaultsNamespace)"""
+    # built without recursion, so val can be arbitrarily deep
+    ret = [None]
+    todo = [(t, ret, 0, val)]
+    while todo:
+        t, parent, k, v = todo.pop()
+        if isinstance(v, dict) and isinstance(t, (Dict, Map)):
+            new = DefaultsNamespace({}, t)
+            # the items are replaced in place, to keep their order
+            dict.update(new, v)
+            todo.extend((_specOf(t, i), new, i, item) for i, item in v.items())
+        elif isinstance(v, list) and isinstance(t, List):
+            new = list(v)
+            todo.extend((t.spec, new, i, item) for i, item in enumerate(v))
+        else:
+            new = toNamespace(v)
+        _setItem(parent, k, new)
+    return ret[0]
+
+
+# defaults which can be served without being copied
+_immutableTypes = (str, bytes, int, float, bool, type(None))
+
+
+class DefaultsNamespace(Namespace):
+
+    """a Namespace whose missing keys are read from the defaults of its spec
+
+    Immutable defaults are never stored, the other ones are copied and stored on first
+    access, so that they are not shared between dicts. materialize() stores them all.
+    """
+
+    # the internal attributes are private, so that they do not hide the keys of the config
+    __slots__ = ('__type',)
+
+    def __new__(cls, val, t):
+        return dict.__new__(cls)
+
+    def __init__(self, val, t):
+        object.__setattr__(self, '_DefaultsNamespace__type', t)
+        for k, v in val.items():
+            dict.__setitem__(self, k, defaultsView(_specOf(self.__type, k), v))
+
+    def __defaults(self):
+        if not isinstance(self.__type, Dict):
+            return ()
+        if self.__type._keys is None:
+            self.__type.optimize()
+        return self.__type._defaults
+
+    def __missingDefaults(self):
+        return [(k, d) for k, d in self.__defaults() if not dict.__contains__(self, k)]
+
+    def __missing__(self, k):
+        for dk, d in self.__defaults():
+            if dk == k:
+                if isinstance(d, _immutableTypes):
+                    return d
+                v = defaultsView(_specOf(self.__type, k), copy.deepcopy(d))
+                dict.__setitem__(self, k, v)
+                return v
+        raise KeyError(k)
+
+    def materialize(self):
+        """store all the defaults, recursively, and return self"""
+        # without recursion, so the document can be arbitrarily deep
+        todo = [self]
+        while todo:
+            v = todo.pop()
+            if isinstance(v, DefaultsNamespace):
+                for k, _ in v.__missingDefaults():
+                    dict.__setitem__(v, k, v[k])
+                todo.extend(dict.values(v))
+            elif isinstance(v, list):
+                todo.extend(v)
+        return self
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError as e:
+            raise AttributeError(e)
+
+    def __contains__(self, k):
+        return dict.__contains__(self, k) or any(dk == k for dk, _ in self.__missingDefaults())
+
+    def get(self, k, default=None):
+        try:
+            return self[k]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(dict.keys(self)) + [k for k, _ in self.__missingDefaults()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return dict.__len__(self) + len(self.__missingDefaults())
+
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def __setitem__(self, k, v):
+        dict.__setitem__(self, k, defaultsView(_specOf(self.__type, k), v))
+
+    __setattr__ = __setitem__
+
+    def __eq__(self, other):
+        return dict(self.items()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return Namespace.__repr__(Namespace(dict(self.items())))
+
+    def __reduce__(self):
+        return (Namespace, (dict(self.items()),))
+
+    def __deepcopy__(self, memo):
+        return Namespace(copy.deepcopy(dict(self.items())))
+
+    def __copy__(self):
+        return Namespace(dict(self.items()))
+
+    copy = __copy__
+
+
+def _parseYaml(content, Loader=None):
+    from . import yaml
+    y = yaml.load(content, Loader=Loader or yaml.DuplicateCheckLoader)
     if y is None:
         return Namespace({})
     return y
 
 
-def _parseOrderedYaml(content):
-    y = yaml.load(content, Loader=yaml.OrderedMapAndDuplicateCheckLoader)
+def _parseOrderedYaml(content, Loader=None):
+    from . import yaml
+    y = yaml.load(content, Loader=Loader or yaml.OrderedMapAndDuplicateCheckLoader)
     if y is None:
         return Namespace({})
     return y
 
 
-def yamlLoad(fn):
+def _readYaml(fn, Loader=None):
+    """the content of the file fn, read up to the maxBytes limit of Loader if any"""
+    maxBytes = getattr(Loader, "maxBytes", None)
+    with open(fn, "r") as f:
+        if maxBytes is None:
+            return f.read()
+        from . import yaml
+        # regular files are checked before being read, the others are read up to the
+        # limit, and their content is checked by the loader
+        yaml.checkSize(Loader, f)
+        return f.read(maxBytes + 1)
+
+
+def yamlLoad(fn, Loader=None):
     path = os.path.basename(fn)
     try:
-        content = open(fn, "r").read()
-        return _parseYaml(content)
+        content = _readYaml(fn, Loader)
+        return _parseYaml(content, Loader)
     except Exception as e:
         raise YamlError(path, "", str(e))
 
 
-def orderedYamlLoad(fn):
+def orderedYamlLoad(fn, Loader=None):
     path = os.path.basename(fn)
     try:
-        content = open(fn, "r").read()
-        return _parseOrderedYaml(content)
+        content = _readYaml(fn, Loader)
+        return _parseOrderedYaml(content, Loader)
     except Exception as e:
         raise YamlError(path, "", str(e))
 
@@ -200,52 +1299,497 @@ def findSpec(fn, yamltypes_dirs, exists=os.path.exists):
             return None
         basespecfn = basespecfn.split(".", 1)[1]
 
-class YamlConfigBuilder(object):
+
+def specCandidates(fn, yamltypes_dirs):
+    """return the spec of fn (see findSpec), and the paths looked for before it was found:
+    creating one of them changes the spec of fn"""
+    missing = []
+
+    def exists(path):
+        if os.path.exists(path):
+            return True
+        missing.append(path)
+        return False
+    return findSpec(fn, yamltypes_dirs, exists), missing
+
+
+def createType(types, path, name, spec):
+    """compile the type spec found at path, types being the named types it can use
+
+    The kids are compiled on an explicit stack of generators rather than on the
+    python stack, so specs can be arbitrarily deep.
+    """
+    stack = [_createTypeSteps(types, path, name, spec)]
+    ret = None
+    while stack:
+        try:
+            kid = stack[-1].send(ret)
+        except StopIteration as e:
+            stack.pop()
+            ret = e.value
+        else:
+            stack.append(_createTypeSteps(types, *kid))
+            ret = None
+    return ret
+
+
+def _createTypeSteps(types, path, name, spec):
+    """generator compiling the type spec, which yields the (path, name, spec) of its
+    kids, and is sent their compiled types"""
+    # only the first level of the spec is modified
+    spec = copy.copy(spec)
+    try:
+        iter(spec)
+    except TypeError:
+        raise YamlError(path, spec, "Item should be iterable but is of type %s" % (type(spec),))
+    if "type" not in spec:
+        raise YamlError(path, spec, "type spec must contain a 'type' key.")
+    t = spec["type"]
+
+    def get_component_type(t):
+        t = t[t.index("of") + 2:]
+        # manage the case: listoflistsoflistsofsetsofstrings
+        for i in "listsof setsof mapsof".split():
+            if t.startswith(i):
+                return t.replace("sof", "of", 1)
+        return t[:-1]  # remove final 's'
+
+    def getType(kt):
+        try:
+            return types[kt]
+        except KeyError as e:
+            raise KeyError("Invalid type {e} for node '{node}'. Available: {types!r}"
+                           .format(node=path, e=e, types=list(types.keys())))
+
+    modifiers = {}
+    for k in Type.modifiers:
+        if k in spec:
+            # for required and forbidden, we allow conditionnal requirement
+            # depending on content of the data. Those are evaluated at match time
+            # so that the compiled spec does not depend on the document.
+            if k in "required forbidden maybenull".split() and isinstance(spec[k], str):
+                spec[k] = Condition(path, spec[k])
+            modifiers[k] = spec[k]
+
+    ret = None
+    for tname, ttype in list(dict(string=str, integer=int,
+                             boolean=bool, float=float,
+                             anything="anything").items()):
+        if t == tname:
+            kw = {}
+            for k in "values".split():
+                if k in spec:
+                    kw[k] = spec[k]
+            kw.update(modifiers)
+            # leaf types are named after their base type so that
+            # identical leaves can be shared
+            ret = Type(tname, ttype, **kw)
+
+    if ret:
+        pass
+    elif t.startswith("listof"):
+        tname = get_component_type(t)
+        spec["type"] = tname
+        ret = List(name, list, (yield path + "[]." + tname, tname, spec), **modifiers)
+    elif t.startswith("mapof"):
+        tname = get_component_type(t)
+        spec["type"] = tname
+        names_type = None
+        if "names_type" in list(spec.keys()):
+            kt = spec["names_type"]
+            if isinstance(kt, str):
+                names_type = getType(kt)
+            else:
+                names_type = yield path + "[name]." + tname, tname, kt
+
+        ret = Map(name, dict, (yield path + "[]." + tname, tname, spec),
+                  names_type=names_type, **modifiers)
+    elif t.startswith("dict"):
+        kids = {}
+        if 'kids' not in spec:
+            raise YamlError(path, spec, "dict type has no 'kids': %r" % (spec,))
+        if spec["kids"] is None:
+            raise YamlError(path, spec,
+                            "spec[\"kids\"] is None")
+        for k, v in list(spec["kids"].items()):
+            kids[k] = yield path + "." + k, k, v
+        ret = Dict(name, dict, kids, **modifiers)
+    elif t.startswith("setof"):
+        tname = get_component_type(t)
+        spec["type"] = tname
+        ret = Set(name, list, (yield path + "[]." + tname, tname, spec), **modifiers)
+    elif t not in types:
+        raise YamlError(path, spec, "unknown type: %s (supported: %s)" % (t, ", ".join(types)))
+    else:
+        # compiled types are never modified, so a shallow copy is enough
+        ret = types[t].withModifiers(**modifiers)
+    return internType(ret)
+
+
+def importTypes(types, fn, load, create=None):
+    """compile the types of the file fn, loaded by load, into types
+    create(path, name, spec) compiles each of them, createType by default.
+    """
+    if create is None:
+        def create(path, name, spec):
+            return createType(types, path, name, spec)
+    path = os.path.basename(fn)
+    if os.path.exists(fn):
+        types_to_import = list(load(fn).items())
+        problematics = []
+        while types_to_import and len(problematics) != len(types_to_import):
+            name, spec = types_to_import.pop(0)
+            try:
+                types[name] = create(path + ":" + name, name, spec)
+                problematics = []
+            except Exception as e:
+                if isinstance(e, TypeError):
+                    raise
+                problematics.append(e)
+                types_to_import.append((name, spec))
+        if problematics:
+            raise problematics[0]
+
+
+class YamlSpec(object):
+
+    """a compiled .meta.yaml file, with the types it imports
+
+    It does not depend on the validated documents, so it can be compiled once
+    and used to validate any number of them.
+    """
+
+    _stringValues = None
+    _usesConditions = None
+    # cache of the parsed type files, see cache.ParsedFileCache
+    fileCache = None
 
     def _yamlLoad(self, fn):
+        if self.fileCache is not None:
+            return self.fileCache.load(fn, yamlLoad)
         return yamlLoad(fn)
 
+    def _parse(self, content):
+        # the documents given as str come from other processes: no python tags
+        from . import yaml
+        return _parseYaml(content, yaml.SafeDuplicateCheckLoader)
+
+    def __init__(self, specfn, yamltypes_dirs=None, additionnal_types=None, name=None,
+                 fileCache=None, builder=None):
+        if fileCache is not None:
+            self.fileCache = fileCache
+        # if not specified, default to the directory the spec file is in
+        if not yamltypes_dirs:
+            yamltypes_dirs = [os.path.dirname(os.path.abspath(specfn))]
+        if name is None:
+            name = os.path.basename(specfn).replace(".meta.yaml", "")
+        self.specfn = specfn
+        self.name = name
+        self.types = {}
+        # all the files the spec was compiled from
+        self.sources = [specfn]
+        # the type files which were looked for, but do not exist
+        self.missing = []
+        # the files are loaded, and the types compiled by the builder the spec is
+        # compiled for, if any, so that its subclasses can customize them
+        compiler = self
+        if builder is not None:
+            compiler = builder
+            builder.types = self.types
+        specbasedir = os.path.dirname(specfn)
+        if additionnal_types:
+            self._importTypes(compiler, additionnal_types)
+        spec = compiler._yamlLoad(specfn)
+        if 'imports' in spec:
+            for additionnal_type in spec['imports']:
+                for yamltypes_dir in yamltypes_dirs:
+                    additionalfn = os.path.abspath(os.path.join(yamltypes_dir, additionnal_type))
+                    if not os.path.exists(additionalfn):
+                        self.missing.append(additionalfn)
+                        additionalfn = os.path.abspath(os.path.join(specbasedir,
+                                                                    "types",
+                                                                    additionnal_type))
+                    if not os.path.exists(additionalfn):
+                        raise Exception("Unable to find imports {!r}".format(additionnal_type))
+                    self._importTypes(compiler, additionalfn)
+        self.root = compiler.createType(name, name, spec["root"])
+        self.root.optimize()
+
+    @classmethod
+    def fromRoot(cls, root, name, types=None):
+        """compile a spec from the type spec of its root, e.g. built in python, instead
+        of a .meta.yaml file. types are the compiled types it can use."""
+        self = cls.__new__(cls)
+        self.specfn = None
+        self.name = name
+        self.types = dict(types or {})
+        self.sources = []
+        self.missing = []
+        self.root = self.createType(name, name, root)
+        self.root.optimize()
+        return self
+
+    def _importTypes(self, compiler, fn):
+        if compiler is self:
+            return self.importTypes(fn)
+        self._recordSource(fn)
+        compiler.importTypes(fn)
+
+    def _recordSource(self, fn):
+        if os.path.exists(fn):
+            self.sources.append(fn)
+        else:
+            self.missing.append(fn)
+
+    def createType(self, path, name, spec):
+        return createType(self.types, path, name, spec)
+
+    def importTypes(self, fn):
+        self._recordSource(fn)
+        importTypes(self.types, fn, self._yamlLoad, self.createType)
+
+    def validate(self, obj, name=None, lazy=False, arrays=False, frozen=False,
+                 lazyDefaults=False, sample=None, record=None):
+        """validate obj against the spec, and return it as a Namespace
+
+        obj is either an already decoded python object, or a yaml (or json) document
+        given as str or bytes, which is parsed without the python specific tags (it can
+        come from untrusted processes). Like for the files, the defaults are filled in obj.
+        """
+        if name is None:
+            name = self.name
+        if isinstance(obj, (str, bytes)):
+            try:
+                obj = self._parse(obj)
+            except Exception as e:
+                raise YamlError(name, "", str(e))
+        return self.validateObject(obj, name, lazy, arrays, frozen, lazyDefaults, sample,
+                                   record)
+
+    def validateObject(self, obj, name=None, lazy=False, arrays=False, frozen=False,
+                       lazyDefaults=False, sample=None, record=None):
+        """validate the python object obj against the spec, and return it as a Namespace
+
+        If lazy is True, only the keys of the root are checked, the values being
+        validated on first access (see LazyNamespace).
+        If arrays is set, the listofintegers and listoffloats are converted to compact
+        arrays once validated (see arrayFactory). Lists holding nulls are kept as is.
+        If frozen is True, the result is deeply frozen (see FrozenNamespace). It cannot
+        be combined with arrays, nor lazyDefaults.
+        If lazyDefaults is True, the defaults are not filled in obj, but served by the
+        result (see DefaultsNamespace). The defaults themselves are then not matched.
+        If sample is set, only a sample of that many elements of the bigger listof and
+        mapof collections of containers are matched (and get their defaults), e.g. for
+        a quick check during development.
+        If record is a ValidationRecord, what obj can be revalidated with is recorded in it
+        (see revalidate).
+        """
+        if name is None:
+            name = self.name
+        if lazy:
+            if arrays or frozen or lazyDefaults or sample is not None or record is not None:
+                raise ValueError("arrays, frozen, lazyDefaults, sample and record are not "
+                                 "supported in lazy mode")
+            return lazyMatch(self.root, name, obj,
+                             MatchContext(obj, conditions=self.usesConditions(), lazy=True))
+        if lazyDefaults and frozen:
+            raise ValueError("lazyDefaults is not supported with frozen")
+        if arrays and frozen:
+            # arrays are mutable and unhashable, and freezing them would lose their compactness
+            raise ValueError("arrays is not supported with frozen")
+        ctx = MatchContext(obj, self.root if lazyDefaults else None, sample,
+                           self.usesConditions(), record=record)
+        self.root.match(name, obj, ctx)
+        if record is not None:
+            record.conditions.update(ctx.values)
+        if arrays:
+            obj = self.root.to_arrays(obj, arrayFactory(arrays))
+        if frozen:
+            return freeze(obj)
+        if lazyDefaults:
+            return defaultsView(self.root, obj)
+        return toNamespace(obj)
+
+    def stringValues(self):
+        """the strings of all the values enumerations of the spec"""
+        if self._stringValues is None:
+            values = set()
+            seen = set()
+            todo = [self.root]
+            while todo:
+                t = todo.pop()
+                if id(t) in seen:
+                    continue
+                seen.add(id(t))
+                values.update(v for v in t.values if isinstance(v, str))
+                todo.extend(t.kid_types())
+            self._stringValues = frozenset(values)
+        return self._stringValues
+
+    def usesConditions(self):
+        """whether the spec has conditional modifiers"""
+        if self._usesConditions is None:
+            self._usesConditions = usesConditions(self.root)
+        return self._usesConditions
+
+    def revalidate(self, obj, paths, name=None, record=None):
+        """validate obj again, after the values at the given paths changed
+
+        obj must have been valid before the changes. Only the changed values, and their
+        containers' keys are matched again. A path is either a selector like in
+        customizations ("a.b.c"), or a sequence of dict keys and list indexes. Defaults
+        are filled like in a full validation.
+        If the spec has conditions, record must be the ValidationRecord given to the
+        validation of obj, and to its previous revalidations: the conditions see the
+        document as it was before its defaults were filled (the keys whose path is given
+        are not defaults anymore), and only the ones which became true are checked again
+        in the whole document.
+        """
+        if name is None:
+            name = self.name
+        conditions = self.usesConditions()
+        if conditions and record is None:
+            raise ValueError("revalidating a document with conditions needs the "
+                             "ValidationRecord of its validation")
+        ctx = MatchContext(obj, conditions=conditions, record=record)
+        for path in paths:
+            if isinstance(path, str):
+                path = path.split(".") if path else []
+            self._revalidatePath(name, obj, path, ctx)
+        if conditions:
+            # the values of the documents the conditions did not require, or forbid, are
+            # still valid, unless the condition is now true
+            changed = set(c for c, v in list(record.conditions.items())
+                          if not v and c.evaluate(name, ctx))
+            if changed:
+                self.root.match_conditions(name, obj, ctx, changed)
+            record.conditions.update(ctx.values)
+
+    def _revalidatePath(self, name, obj, path, ctx):
+        t, val = self.root, obj
+        ancestors = []
+        for k in path:
+            if isinstance(t, (Dict, Map)) and isinstance(val, dict):
+                if ctx.filled is not None and k in _filledKeys(ctx.filled, val):
+                    # set, or deleted, by the changes
+                    ctx.filled[id(val)][1].discard(k)
+                if k not in val or (isinstance(t, Dict) and k not in t.spec):
+                    # deleted, or unknown key: only the container's keys must be checked
+                    t.match_level(name, val, ctx)
+                    return
+                ancestors.append((t, name, val))
+                t, name, val = t.spec_of(k), name + "." + k, val[k]
+            elif isinstance(t, List) and isinstance(val, list):
+                k = int(k)
+                if k >= len(val):
+                    t.match_level(name, val, ctx)
+                    return
+                ancestors.append((t, name, val))
+                t, name, val = t.spec, "%s[%d]" % (name, k), val[k]
+            else:
+                # the path goes through a value which is not a container anymore
+                break
+        else:
+            if ancestors:
+                parent, parentname, parentval = ancestors[-1]
+                parent.match_level(parentname, parentval, ctx)
+        t.match(name, val, ctx)
+        # the changed values can now be duplicates in their sets
+        for parent, parentname, parentval in ancestors:
+            if isinstance(parent, Set):
+                parent.check_unique(parentname, parentval)
+
+
+class OrderedYamlSpec(YamlSpec):
+
+    def _yamlLoad(self, fn):
+        if self.fileCache is not None:
+            return self.fileCache.load(fn, orderedYamlLoad)
+        return orderedYamlLoad(fn)
+
+    def _parse(self, content):
+        from . import yaml
+        return _parseOrderedYaml(content, yaml.SafeOrderedMapAndDuplicateCheckLoader)
+
+
+class YamlConfigBuilder(object):
+
+    specClass = YamlSpec
+    loaderClassName = "DuplicateCheckLoader"
+    loader = None
+    # cache of the parsed data and customization files, see cache.ParsedFileCache
+    fileCache = None
+
+    def _yamlLoad(self, fn):
+        if self.fileCache is not None:
+            return self.fileCache.load(fn, yamlLoad, self.loader)
+        return yamlLoad(fn, self.loader)
 
     def __init__(self, fn, customizations=None, additionnal_types=None,
-                 specfn=None, yamltypes_dirs=None, needSpec=True):
+                 specfn=None, yamltypes_dirs=None, needSpec=True, spec=None, lazy=False,
+                 arrays=False, intern=False, frozen=False, limits=None, fileCache=None,
+                 lazyDefaults=False, sample=None):
+        if fileCache is not None:
+            self.fileCache = fileCache
         if customizations is None:
             customizations = []
+        # the files which were looked for, but do not exist: the specs more specific than
+        # the one which was found, and the missing type files
+        self.missing = []
         # if not specified, default to the directory the yaml file is in
         if not yamltypes_dirs:
             yamltypes_dirs = []
             yamltypes_dirs.append(os.path.dirname(os.path.abspath(fn)))
+        tname = os.path.basename(fn.replace(".yaml", ""))
+        if intern or limits:
+            from . import yaml
+            loader = getattr(yaml, self.loaderClassName)
+            if limits:
+                # e.g. dict(maxBytes=1 << 20, maxNodes=100000), see yaml.limitedLoader
+                loader = yaml.limitedLoader(loader, **limits)
+            if intern:
+                # the spec is needed first, to intern its values while loading
+                if spec is None:
+                    spec = self._compileSpec(fn, specfn, yamltypes_dirs, additionnal_types,
+                                             tname)
+                if spec is not None:
+                    yaml.internTable.update(spec.stringValues())
+                loader = yaml.interningLoader(loader)
+            self.loader = loader
         self._dict = self._yamlLoad(fn)
         self.mixCustomizations(os.path.basename(fn), customizations)
-        self._ns = Namespace(self._dict)
-        self.types = {}
-        if not specfn:
-            specfn = findSpec(fn, yamltypes_dirs)
-        if specfn is not None:
-            specbasedir = os.path.dirname(specfn)
-            if additionnal_types:
-                self.importTypes(additionnal_types)
-            spec = self._yamlLoad(specfn)
-            tname = os.path.basename(fn.replace(".yaml", ""))
-            if 'imports' in spec:
-                for additionnal_type in spec['imports']:
-                    for yamltypes_dir in yamltypes_dirs:
-                        additionalfn = os.path.abspath(os.path.join(yamltypes_dir, additionnal_type))
-                        if not os.path.exists(additionalfn):
-                            additionalfn = os.path.abspath(os.path.join(specbasedir,
-                                                                        "types",
-                                                                        additionnal_type))
-                        if not os.path.exists(additionalfn):
-                            raise Exception("Unable to find imports {!r}".format(additionnal_type))
-                        self.importTypes(additionalfn)
-            t = self.createType(tname, tname, spec["root"])
-            t.match(tname, self._dict)
+        if spec is None:
+            spec = self._compileSpec(fn, specfn, yamltypes_dirs, additionnal_types, tname)
+        self.spec = spec
+        if spec is not None:
+            self.missing.extend(spec.missing)
+            self.types = spec.types
             # rebuild the Namespace, self._dict may contain
             # more data, filled by the default
-
-            self._ns = Namespace(self._dict)
+            self._ns = spec.validateObject(self._dict, tname, lazy=lazy, arrays=arrays,
+                                           frozen=frozen, lazyDefaults=lazyDefaults,
+                                           sample=sample)
         else:
             if needSpec:
                 raise ValueError("no spec found for %s" % (fn, ))
+            self.types = {}
+            self._ns = toNamespace(self._dict)
+
+    def _compileSpec(self, fn, specfn, yamltypes_dirs, additionnal_types, name):
+        if not specfn:
+            specfn, missing = specCandidates(fn, yamltypes_dirs)
+            self.missing.extend(missing)
+        if specfn is None:
+            return None
+        return self.specClass(specfn, yamltypes_dirs=yamltypes_dirs,
+                              additionnal_types=additionnal_types, name=name,
+                              fileCache=self.fileCache, builder=self)
+
+    def createType(self, path, name, spec):
+        return createType(self.types, path, name, spec)
+
+    def importTypes(self, fn):
+        importTypes(self.types, fn, self._yamlLoad, self.createType)
 
     @staticmethod
     def applyCustomizationRule(obj, selector, value):
@@ -269,10 +1813,10 @@ class YamlConfigBuilder(object):
                                      % (orig_selector, selector, obj))
 
         if action in ["REPLACE", "DELETEIF"] and selector and selector not in obj:
-            cactusLog.debug("Selector: %r, object doesn't have the selector yet, Action: %r, Value: %r",
+            _getLog().debug("Selector: %r, object doesn't have the selector yet, Action: %r, Value: %r",
                             selector, action, value)
         elif selector:
-            cactusLog.debug("Selector: %r, object: %r, Action: %r, Value: %r", selector, obj[selector], action, value)
+            _getLog().debug("Selector: %r, object: %r, Action: %r, Value: %r", selector, obj[selector], action, value)
 
         if action == "REPLACE" and selector:
             obj[selector] = value
@@ -334,14 +1878,14 @@ class YamlConfigBuilder(object):
         for customization in customizations:
             basedir = os.path.dirname(customization)
             customfn = os.path.basename(customization)
-            custom = Namespace(self._yamlLoad(customization))
+            custom = toNamespace(self._yamlLoad(customization))
             if custom:
                 if "imports" in custom:
                     import_customs = [os.path.realpath(os.path.join(basedir, cnfn))
                                       for cnfn in custom['imports']]
                     self.mixCustomizations(fn, import_customs)
                 if fn in custom and custom[fn] is not None:
-                    cactusLog.debug("Applying customization: %s", custom[fn])
+                    _getLog().debug("Applying customization: %s", custom[fn])
                     # DELETE_ALL must be done first
                     if DELETE_ALL_ACTION in custom[fn]:
                         value = custom[fn][DELETE_ALL_ACTION]
@@ -352,131 +1896,31 @@ class YamlConfigBuilder(object):
                             continue
                         doCustomization(selector, value)
 
-    def createType(self, path, name, spec):
-        spec = copy.deepcopy(spec)
-        try:
-            iter(spec)
-        except TypeError:
-            raise YamlError(path, spec, "Item should be iterable but is of type %s" % (type(spec),))
-        if "type" not in spec:
-            raise YamlError(path, spec, "type spec must contain a 'type' key.")
-        t = spec["type"]
-
-        def get_component_type(t):
-            t = t[t.index("of") + 2:]
-            # manage the case: listoflistsoflistsofsetsofstrings
-            for i in "listsof setsof mapsof".split():
-                if t.startswith(i):
-                    return t.replace("sof", "of", 1)
-            return t[:-1]  # remove final 's'
-
-        def getType(kt):
-            try:
-                return self.types[kt]
-            except KeyError as e:
-                raise KeyError("Invalid type {e} for node '{node}'. Available: {types!r}"
-                               .format(node=path, e=e, types=list(self.types.keys())))
-
-        ret = None
-        for tname, ttype in list(dict(string=str, integer=int,
-                                 boolean=bool, float=float,
-                                 anything="anything").items()):
-            if t == tname:
-                kw = {}
-                for k in "values".split():
-                    if k in spec:
-                        kw[k] = spec[k]
-                ret = Type(name, ttype, **kw)
-
-        if ret:
-            pass
-        elif t.startswith("listof"):
-            tname = get_component_type(t)
-            spec["type"] = tname
-            ret = List(name, list,
-                       self.createType(path + "[]." + tname,
-                                       tname, spec))
-        elif t.startswith("mapof"):
-            tname = get_component_type(t)
-            spec["type"] = tname
-            names_type = None
-            if "names_type" in list(spec.keys()):
-                kt = spec["names_type"]
-                if isinstance(kt, str):
-                    names_type = getType(kt)
-                else:
-                    names_type = self.createType(path + "[name]." + tname,
-                                                 tname, kt)
-
-            ret = Map(name, dict,
-                      self.createType(path + "[]." + tname,
-                                      tname, spec),
-                      names_type=names_type)
-        elif t.startswith("dict"):
-            kids = {}
-            if 'kids' not in spec:
-                raise YamlError(path, spec, "dict type has no 'kids': %r" % (spec,))
-            if spec["kids"] is None:
-                raise YamlError(path, spec,
-                                "spec[\"kids\"] is None")
-            for k, v in list(spec["kids"].items()):
-                kids[k] = self.createType(path + "." + k, k, v)
-            ret = Dict(name, dict, kids)
-        elif t.startswith("setof"):
-            tname = get_component_type(t)
-            spec["type"] = tname
-            ret = Set(name, list, self.createType(path + "[]." + tname,
-                                                  tname, spec))
-        elif t not in self.types:
-            raise YamlError(path, spec, "unknown type: %s (supported: %s)" % (t, ", ".join(self.types)))
-        else:
-            ret = copy.deepcopy(self.types[t])
-        for k in "required default forbidden maybenull".split():
-            if k in spec:
-                # for required and forbidden, we allow conditionnal requirement
-                # depending on content of the data
-                if k in "required forbidden maybenull".split() and isinstance(spec[k], str):
-                    try:
-                        spec[k] = eval(spec[k], dict(),
-                                       dict(self=self._ns))
-                    except Exception as e:
-                        raise YamlError(path, spec[k],
-                                        "issue with python expression in yaml:\n" + str(e))
-                setattr(ret, k, spec[k])
-            else:
-                setattr(ret, k, None)
-        return ret
-
-    def importTypes(self, fn):
-        path = os.path.basename(fn)
-        if os.path.exists(fn):
-            types_to_import = list(self._yamlLoad(fn).items())
-            problematics = []
-            while types_to_import and len(problematics) != len(types_to_import):
-                name, spec = types_to_import.pop(0)
-                try:
-                    self.types[name] = self.createType(path + ":" + name, name, spec)
-                    problematics = []
-                except Exception as e:
-                    if isinstance(e, TypeError):
-                        raise
-                    problematics.append(e)
-                    types_to_import.append((name, spec))
-            if problematics:
-                raise problematics[0]
-
 
 class OrderedYamlConfigBuilder(YamlConfigBuilder):
 
+    specClass = OrderedYamlSpec
+    loaderClassName = "OrderedMapAndDuplicateCheckLoader"
+
     def _yamlLoad(self, fn):
-        return orderedYamlLoad(fn)
+        if self.fileCache is not None:
+            return self.fileCache.load(fn, orderedYamlLoad, self.loader)
+        return orderedYamlLoad(fn, self.loader)
 
 
 def YamlConfig(*args, **kw):
+    snapshotDir = kw.pop("snapshotDir", None)
+    if snapshotDir is not None:
+        from .snapshot import loadConfig
+        return loadConfig(YamlConfigBuilder, snapshotDir, *args, **kw)
     b = YamlConfigBuilder(*args, **kw)
     return b._ns
 
 
 def OrderedYamlConfig(*args, **kw):
+    snapshotDir = kw.pop("snapshotDir", None)
+    if snapshotDir is not None:
+        from .snapshot import loadConfig
+        return loadConfig(OrderedYamlConfigBuilder, snapshotDir, *args, **kw)
     b = OrderedYamlConfigBuilder(*args, **kw)
     return b._ns